@@ -2,11 +2,9 @@ import logging
 
 import numpy as np
 from scipy import constants
-from scipy import optimize
-import matplotlib.pyplot as plt
 
 from model import length_los, length_ref
-from util import to_decibel, export_results
+from util import to_decibel, export_results, newton_bisect_vectorized
 from two_frequencies import sum_power_lower_envelope, delta_freq_peak_approximation
 
 
@@ -14,6 +12,7 @@ LOGGER = logging.getLogger(__name__)
 
 
 def find_peak_delta_freq(freq, distance, h_tx, h_rx, c=constants.c):
+    from scipy import optimize
     d_los = length_los(distance, h_tx, h_rx)
     d_ref = length_ref(distance, h_tx, h_rx)
     omega = 2*np.pi*freq
@@ -32,14 +31,62 @@ def find_peak_delta_freq(freq, distance, h_tx, h_rx, c=constants.c):
     freq_max = sol_max.x[0]/(a*2*np.pi)
     return freq_min, freq_max
 
+def _peak_condition(tau, omega, a, ratio):
+    # Stationarity condition of the lower envelope in terms of the phase
+    # tau = 2*pi*delta_freq*a (zero at the peaks) and its derivative.
+    # ratio is (d_ref**2+d_los**2)/(d_los*d_ref).
+    omega2 = omega + tau/a
+    _root = np.sqrt(1/omega**4 + 1/omega2**4 + 2*np.cos(tau)/(omega**2*omega2**2))
+    _droot = (-2/(a*omega2**5) - np.sin(tau)/(omega**2*omega2**2)
+              - 2*np.cos(tau)/(a*omega**2*omega2**3))/_root
+    value = ratio*_root - (2/omega2**2 + (2*np.cos(tau) + (a*omega+tau)*np.sin(tau))/omega**2)
+    derivative = ratio*_droot - (-4/(a*omega2**3) + (-np.sin(tau) + (a*omega+tau)*np.cos(tau))/omega**2)
+    return value, derivative
+
+def find_peak_delta_freq_batch(freq, distance, h_tx, h_rx, c=constants.c,
+                               xtol: float = 1e-12):
+    # Array version of find_peak_delta_freq for any broadcastable parameters.
+    # The peaks are the roots of the stationarity condition within the phase
+    # brackets [pi/2, pi] and [3pi/2, 2.2pi]. The last axis of the results
+    # holds both peaks, in the order of delta_freq_peak_approximation.
+    # Returns the exact peak locations and the relative error of the
+    # approximation.
+    freq, distance, h_tx, h_rx = np.broadcast_arrays(
+            *[np.asarray(_x, dtype=float) for _x in (freq, distance, h_tx, h_rx)])
+    _expand = lambda x: np.expand_dims(x, -1)
+    d_los = _expand(length_los(distance, h_tx, h_rx))
+    d_ref = _expand(length_ref(distance, h_tx, h_rx))
+    omega = 2*np.pi*_expand(freq)
+    a = (d_ref-d_los)/c
+    ratio = (d_ref**2+d_los**2)/(d_los*d_ref)
+    _lower = np.broadcast_to([np.pi/2, 3*np.pi/2], np.shape(a)[:-1]+(2,))
+    _upper = np.broadcast_to([np.pi, 2.2*np.pi], np.shape(a)[:-1]+(2,))
+    func = lambda tau: _peak_condition(tau, omega, a, ratio)
+    # For very small path differences relative to the wavelength, the first
+    # peak lies below pi/2. These peaks are outside of the brackets and
+    # returned as NaN.
+    bracketed = np.sign(func(_lower)[0]) != np.sign(func(_upper)[0])
+    if not np.all(bracketed):
+        LOGGER.warning("%d peaks are outside of the search brackets",
+                       np.count_nonzero(~bracketed))
+    tau, info = newton_bisect_vectorized(func, _lower, _upper, xtol=xtol,
+                                         full_output=True)
+    if not np.all(info["converged"][bracketed]):
+        LOGGER.warning("The peak search did not converge for %d configurations",
+                       np.count_nonzero(~info["converged"][bracketed]))
+    freq_peak = np.where(bracketed, tau/(2*np.pi*a), np.nan)
+    rel_error = delta_freq_peak_approximation(_expand(distance), _expand(h_tx),
+                                              _expand(h_rx), c=c)/freq_peak - 1
+    return freq_peak, rel_error
+
 
 def _main_delta_freq_peaks(freq, distance, h_tx, h_rx, c=constants.c):
     #delta_freq = np.logspace(7, 10, 3000)
     #delta_freq = np.logspace(7, np.log10(3e9), 3000)
     delta_freq = np.logspace(7, 9, 1500)
     power_sum_lower = sum_power_lower_envelope(distance, delta_freq, freq, h_tx, h_rx)
-    delta_freq_peak = find_peak_delta_freq(freq, distance, h_tx, h_rx)
-    delta_freq_peak = np.array(delta_freq_peak)
+    delta_freq_peak, rel_error = find_peak_delta_freq_batch(freq, distance, h_tx, h_rx)
+    LOGGER.info(f"Relative error of the approximation: {rel_error}")
     results = {"df": delta_freq, "power": power_sum_lower}
     return results, delta_freq_peak
 
@@ -53,6 +100,7 @@ def main_peaks_approximation(freq, distance, h_tx, h_rx, c=constants.c,
     LOGGER.info(f"Appr. maximum/minimum locations: {df_peak_approximation}")
 
     if plot:
+        import matplotlib.pyplot as plt
         _ylim = [-120, -60]
         fig, axs = plt.subplots()
         axs.set_ylim(_ylim)
@@ -69,6 +117,7 @@ def main_peaks_approximation(freq, distance, h_tx, h_rx, c=constants.c,
 
 if __name__ == "__main__":
     import argparse
+    import matplotlib.pyplot as plt
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--h_tx", type=float, default=10.)
     parser.add_argument("-r", "--h_rx", type=float, default=1.)
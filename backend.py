@@ -0,0 +1,258 @@
+import functools
+import importlib
+import logging
+import os
+
+import numpy as np
+
+
+LOGGER = logging.getLogger(__name__)
+
+BACKENDS = ("numpy", "numexpr", "numba")
+ENV_BACKEND = "TWO_RAY_BACKEND"
+
+# Arrays with less elements than min_size are always evaluated by NumPy, since
+# the dispatch and threading overhead of the other backends dominates there.
+_STATE = {"name": "numpy", "min_size": 100000}
+
+
+def set_backend(name: str = "numpy", min_size: int = None,
+                num_threads: int = None):
+    # The numexpr and numba backends evaluate each formula in a single
+    # multi-threaded loop, using all cores by default.
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend: {name}. Available backends: {BACKENDS}")
+    if name != "numpy":
+        _module = importlib.import_module(name)
+        if num_threads is not None:
+            _module.set_num_threads(num_threads)
+    _STATE["name"] = name
+    if min_size is not None:
+        _STATE["min_size"] = min_size
+    LOGGER.info(f"Using the {name} backend (minimum array size: {_STATE['min_size']:d})")
+
+def get_backend():
+    return _STATE["name"]
+
+def _set_backend_from_env():
+    name = os.environ.get(ENV_BACKEND)
+    if not name:
+        return
+    try:
+        set_backend(name)
+    except (ImportError, ValueError) as e:
+        LOGGER.warning(f"Can not use the backend from {ENV_BACKEND} ({e}). Using numpy.")
+
+
+def get_kernel(name: str, array, *params):
+    # Compiled kernel of the current backend or None, if the NumPy
+    # implementation should be used. This is the case for small arrays and
+    # for array-valued parameters, which the kernels do not broadcast.
+    backend = _STATE["name"]
+    if backend == "numpy":
+        return None
+    if np.size(array) < _STATE["min_size"] or any(np.ndim(_p) > 0 for _p in params):
+        return None
+    if backend == "numexpr":
+        return _NUMEXPR_KERNELS[name]
+    if _NUM_ARRAYS[name] is None:
+        return _numba_kernels()[name]
+    return functools.partial(_call_numba, _numba_kernels()[name],
+                             _NUM_ARRAYS[name])
+
+
+def _rec_power_numexpr(d_los, d_ref, freq, G_los, G_ref, c, power_tx):
+    import numexpr
+    omega = 2*np.pi*freq
+    return numexpr.evaluate(
+            "factor*(G_los/d_los**2 + G_ref/d_ref**2 - gain*cos(k*(d_ref-d_los))/(d_los*d_ref))",
+            local_dict={"d_los": d_los, "d_ref": d_ref,
+                        "factor": power_tx*(c/(2*omega))**2,
+                        "G_los": G_los, "G_ref": G_ref,
+                        "gain": 2*np.sqrt(G_los*G_ref), "k": omega/c})
+
+def _rec_power_lower_envelope_numexpr(d_los, d_ref, freq, G_los, G_ref, c,
+                                      power_tx):
+    import numexpr
+    omega = 2*np.pi*freq
+    return numexpr.evaluate(
+            "factor*(G_los/d_los**2 + G_ref/d_ref**2 - gain/(d_los*d_ref))",
+            local_dict={"d_los": d_los, "d_ref": d_ref,
+                        "factor": power_tx*(c/(2*omega))**2,
+                        "G_los": G_los, "G_ref": G_ref,
+                        "gain": 2*np.sqrt(G_los*G_ref)})
+
+def _sum_power_lower_envelope_numexpr(d_los, d_ref, delta_freq, freq, c,
+                                      power_tx):
+    import numexpr
+    omega = 2*np.pi*freq
+    omega2 = 2*np.pi*(freq+delta_freq)
+    A = (c/(2*omega))**2
+    B = (c/(2*omega2))**2
+    return numexpr.evaluate(
+            "factor*((A+B)*(1/d_los**2 + 1/d_ref**2) - 2/(d_los*d_ref)*sqrt(A**2 + B**2 + 2*A*B*cos(k*(d_ref-d_los))))",
+            local_dict={"d_los": d_los, "d_ref": d_ref, "factor": power_tx/2,
+                        "A": A, "B": B, "k": (omega2-omega)/c})
+
+def _achievable_rate_numexpr(rec_power, noise_power, bw):
+    import numexpr
+    return numexpr.evaluate("bw*log(1 + rec_power/noise_power)/log(2)",
+                            local_dict={"rec_power": rec_power,
+                                        "noise_power": noise_power, "bw": bw})
+
+def _rate_curves_numexpr(distance, single, two, lower, h_tx, h_rx, omega1,
+                         omega2, snr1, snr2, r, snr_lower, alpha, bw, c):
+    # Same forms as the NumPy version of rate_comparison.rate_curves with
+    # a = d_ref-d_los and g = d_los d_ref. Each curve is a single expression,
+    # so there are no full-size temporaries.
+    import numexpr
+    _a = "(hh4/(sqrt(d**2+h_diff2)+sqrt(d**2+h_sum2)))"
+    _g = "(sqrt(d**2+h_diff2)*sqrt(d**2+h_sum2))"
+    _bracket = f"(({_a}**2/{_g} + 4*sin(k*{_a})**2)/{_g})"
+    _params = {"d": distance, "h_diff2": (h_tx-h_rx)**2,
+               "h_sum2": (h_tx+h_rx)**2, "hh4": 4*h_tx*h_rx,
+               "k1": omega1/(2*c), "k2": omega2/(2*c), "kd": (omega2-omega1)/(2*c),
+               "snr1": snr1, "snr2": snr2, "r": r, "snr_lower": snr_lower,
+               "alpha": alpha, "f1": bw/np.log(2), "f2": bw/(2*np.log(2))}
+    _bracket1 = _bracket.replace("k*", "k1*")
+    _bracket2 = _bracket.replace("k*", "k2*")
+    _u = f"(sin(kd*{_a})**2)"
+    numexpr.evaluate(f"f1*log1p(snr1*{_bracket1})", local_dict=_params,
+                     out=single, casting='same_kind')
+    numexpr.evaluate(f"f2*(log1p(snr1*{_bracket1}) + log1p(snr2*{_bracket2}))",
+                     local_dict=_params, out=two, casting='same_kind')
+    numexpr.evaluate(f"f2*log1p(snr_lower*((1+r)*{_a}**2/{_g} + 8*r*{_u}/((1+r) + sqrt((1+r)**2 - 4*r*{_u})))/{_g} + alpha)",
+                     local_dict=_params, out=lower, casting='same_kind')
+
+# Number of array arguments of the kernels. None marks kernels that write
+# into output arrays passed by the caller.
+_NUM_ARRAYS = {"rec_power": 2, "rec_power_lower_envelope": 2,
+               "sum_power_lower_envelope": 2, "achievable_rate": 1,
+               "rate_curves": None}
+
+_NUMEXPR_KERNELS = {"rec_power": _rec_power_numexpr,
+                    "rec_power_lower_envelope": _rec_power_lower_envelope_numexpr,
+                    "sum_power_lower_envelope": _sum_power_lower_envelope_numexpr,
+                    "achievable_rate": _achievable_rate_numexpr,
+                    "rate_curves": _rate_curves_numexpr}
+
+
+def _call_numba(kernel, num_arrays, *args):
+    # The numba kernels work on flat arrays and write into the output array.
+    arrays = np.broadcast_arrays(*[np.asarray(_a, dtype=float)
+                                   for _a in args[:num_arrays]])
+    out = np.empty(arrays[0].shape)
+    kernel(*[np.ravel(_a) for _a in arrays],
+           *[float(_x) for _x in args[num_arrays:]], out.ravel())
+    return out
+
+@functools.lru_cache(maxsize=None)
+def _numba_kernels():
+    import numba
+
+    @numba.njit(parallel=True, cache=True)
+    def rec_power(d_los, d_ref, freq, G_los, G_ref, c, power_tx, out):
+        omega = 2*np.pi*freq
+        factor = power_tx*(c/(2*omega))**2
+        gain = 2*np.sqrt(G_los*G_ref)
+        for i in numba.prange(len(d_los)):
+            phi = omega/c*(d_ref[i]-d_los[i])
+            out[i] = factor*(G_los/d_los[i]**2 + G_ref/d_ref[i]**2
+                             - gain/(d_los[i]*d_ref[i])*np.cos(phi))
+
+    @numba.njit(parallel=True, cache=True)
+    def rec_power_lower_envelope(d_los, d_ref, freq, G_los, G_ref, c,
+                                 power_tx, out):
+        omega = 2*np.pi*freq
+        factor = power_tx*(c/(2*omega))**2
+        gain = 2*np.sqrt(G_los*G_ref)
+        for i in numba.prange(len(d_los)):
+            out[i] = factor*(G_los/d_los[i]**2 + G_ref/d_ref[i]**2
+                             - gain/(d_los[i]*d_ref[i]))
+
+    @numba.njit(parallel=True, cache=True)
+    def sum_power_lower_envelope(d_los, d_ref, delta_freq, freq, c, power_tx,
+                                 out):
+        omega = 2*np.pi*freq
+        omega2 = 2*np.pi*(freq+delta_freq)
+        A = (c/(2*omega))**2
+        B = (c/(2*omega2))**2
+        k = (omega2-omega)/c
+        for i in numba.prange(len(d_los)):
+            _root = np.sqrt(A**2 + B**2 + 2*A*B*np.cos(k*(d_ref[i]-d_los[i])))
+            out[i] = power_tx/2*((A+B)*(1/d_los[i]**2 + 1/d_ref[i]**2)
+                                 - 2/(d_los[i]*d_ref[i])*_root)
+
+    @numba.njit(parallel=True, cache=True)
+    def achievable_rate(rec_power, noise_power, bw, out):
+        for i in numba.prange(len(rec_power)):
+            out[i] = bw*np.log2(1 + rec_power[i]/noise_power)
+
+    @numba.njit(parallel=True, cache=True)
+    def rate_curves(distance, single, two, lower, h_tx, h_rx, omega1, omega2,
+                    snr1, snr2, r, snr_lower, alpha, bw, c):
+        for i in numba.prange(len(distance)):
+            d_los = np.sqrt(distance[i]**2 + (h_tx-h_rx)**2)
+            d_ref = np.sqrt(distance[i]**2 + (h_tx+h_rx)**2)
+            a = 4*h_tx*h_rx/(d_los+d_ref)
+            g = d_los*d_ref
+            b = a**2/g
+            _rate1 = np.log1p(snr1*(b + 4*np.sin(a*omega1/(2*c))**2)/g)
+            _rate2 = np.log1p(snr2*(b + 4*np.sin(a*omega2/(2*c))**2)/g)
+            single[i] = bw/np.log(2)*_rate1
+            two[i] = bw/(2*np.log(2))*(_rate1 + _rate2)
+            u = np.sin(a*(omega2-omega1)/(2*c))**2
+            _bracket = ((1+r)*b + 8*r*u/((1+r) + np.sqrt((1+r)**2 - 4*r*u)))/g
+            lower[i] = bw/(2*np.log(2))*np.log1p(snr_lower*_bracket + alpha)
+
+    return {"rec_power": rec_power,
+            "rec_power_lower_envelope": rec_power_lower_envelope,
+            "sum_power_lower_envelope": sum_power_lower_envelope,
+            "achievable_rate": achievable_rate,
+            "rate_curves": rate_curves}
+
+
+def check_backend(name: str = None, num_points: int = 1000000,
+                  rtol: float = 1e-9):
+    # Compares the kernels of a backend with the NumPy implementation. The
+    # powers are compared relative to the free-space power of the direct path,
+    # since the relative error of both implementations is unbounded at the
+    # fading nulls. Returns the maximum deviation of each function.
+    from single_frequency import rec_power, rec_power_lower_envelope
+    from two_frequencies import sum_power_lower_envelope
+    from util import achievable_rate
+    from model import LinkGeometry
+    from rate_comparison import rate_curves
+    _previous = (_STATE["name"], _STATE["min_size"])
+    if name is None:
+        name = _previous[0]
+    distance = np.logspace(0, 4, num_points)
+    geometry = LinkGeometry(distance, 10., 1.5)
+    freq, delta_freq, bw = 2.4e9, 1.5e7, 1e6
+    functions = {
+        "rec_power": lambda: rec_power(geometry, freq, 10., 1.5),
+        "rec_power_lower_envelope": lambda: rec_power_lower_envelope(geometry, freq, 10., 1.5),
+        "sum_power_lower_envelope": lambda: sum_power_lower_envelope(geometry, delta_freq, freq, 10., 1.5),
+        "achievable_rate": lambda: achievable_rate(rec_power(geometry, freq, 10., 1.5), bw),
+        "rate_curves": lambda: np.stack(rate_curves(distance, freq, delta_freq, 10., 1.5, bw, d_max=100.)),
+        }
+    _scale = {"achievable_rate": bw, "rate_curves": bw}
+    deviation = {}
+    try:
+        set_backend("numpy")
+        reference = {k: v() for k, v in functions.items()}
+        set_backend(name, min_size=0)
+        for _name, _func in functions.items():
+            _ref = reference[_name]
+            _norm = _scale.get(_name, (3e8/(4*np.pi*freq*distance))**2)
+            deviation[_name] = np.max(np.abs(_func()-_ref)/_norm)
+            LOGGER.info(f"Deviation of {_name} ({name}): {deviation[_name]:.2E}")
+    finally:
+        set_backend(*_previous)
+    failed = [k for k, v in deviation.items() if not v <= rtol]
+    if failed:
+        raise AssertionError(f"The {name} backend deviates from numpy for: {', '.join(failed)}")
+    return deviation
+
+
+_set_backend_from_env()
@@ -0,0 +1,155 @@
+import atexit
+import collections
+import copy
+import functools
+import importlib
+import inspect
+import logging
+import shelve
+
+import numpy as np
+
+
+LOGGER = logging.getLogger(__name__)
+
+CacheInfo = collections.namedtuple("CacheInfo", ["hits", "misses", "disk_hits",
+                                                 "maxsize", "currsize"])
+
+_MEMOIZED = {}
+_DISK = {"file": None, "shelf": None}
+
+
+class NotCacheable(TypeError):
+    pass
+
+
+def _normalize(value, digits=12):
+    # Floats are rounded to a fixed number of significant digits, so that
+    # numerically identical parameters share the same key.
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return float(f"{float(value):.{digits}g}")
+    _array = np.asarray(value)
+    if _array.ndim == 0 and _array.dtype.kind in "biuf":
+        return _normalize(_array.item(), digits=digits)
+    raise NotCacheable(f"Parameter of type {type(value)} can not be cached")
+
+
+class _Memoized:
+    def __init__(self, func, maxsize):
+        self.func = func
+        self.maxsize = maxsize
+        self.name = f"{func.__module__}.{func.__qualname__}"
+        self._signature = inspect.signature(func)
+        self._cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        functools.update_wrapper(self, func)
+
+    def _key(self, args, kwargs):
+        _bound = self._signature.bind(*args, **kwargs)
+        _bound.apply_defaults()
+        return tuple((_name, _normalize(_value))
+                     for _name, _value in _bound.arguments.items())
+
+    def __call__(self, *args, **kwargs):
+        try:
+            key = self._key(args, kwargs)
+        except NotCacheable:
+            return self.func(*args, **kwargs)
+        if key in self._cache:
+            self.hits = self.hits + 1
+            self._cache.move_to_end(key)
+            return _copy(self._cache[key])
+        _shelf = _DISK["shelf"]
+        _disk_key = f"{self.name}:{key!r}"
+        if _shelf is not None and _disk_key in _shelf:
+            self.disk_hits = self.disk_hits + 1
+            result = _shelf[_disk_key]
+        else:
+            self.misses = self.misses + 1
+            result = self.func(*args, **kwargs)
+            if _shelf is not None:
+                _shelf[_disk_key] = result
+                _shelf.sync()
+        self._cache[key] = result
+        if self.maxsize is not None and len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return _copy(result)
+
+    def __reduce__(self):
+        return (_lookup, (self.func.__module__, self.func.__qualname__))
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.disk_hits, self.maxsize,
+                         len(self._cache))
+
+    def cache_clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        _shelf = _DISK["shelf"]
+        if _shelf is not None:
+            for _key in [k for k in _shelf.keys() if k.startswith(f"{self.name}:")]:
+                del _shelf[_key]
+            _shelf.sync()
+
+
+def _lookup(module, qualname):
+    return getattr(importlib.import_module(module), qualname)
+
+
+def _copy(value):
+    # Callers get their own copy of mutable results (arrays, or containers
+    # like the info dict of full_output), so that modifying a result does not
+    # change the cached value.
+    if isinstance(value, np.ndarray):
+        return np.copy(value)
+    if isinstance(value, (tuple, list, dict)):
+        return copy.deepcopy(value)
+    return value
+
+
+def memoize(maxsize: int = 1024):
+    def decorator(func):
+        wrapper = _Memoized(func, maxsize)
+        _MEMOIZED[wrapper.name] = wrapper
+        return wrapper
+    return decorator
+
+
+def set_cache_file(filename):
+    # Optional on-disk backing of all memoized functions. Passing None
+    # closes the current file. The shelve file has no locking, so it must not
+    # be shared between processes (e.g., the workers of figures.py).
+    _close_cache_file()
+    if filename is not None:
+        LOGGER.info(f"Using cache file: {filename}")
+        _DISK["shelf"] = shelve.open(filename)
+        _DISK["file"] = filename
+
+def _close_cache_file():
+    if _DISK["shelf"] is not None:
+        _DISK["shelf"].close()
+    _DISK["shelf"] = None
+    _DISK["file"] = None
+
+atexit.register(_close_cache_file)
+
+
+def cache_info():
+    return {_name: _func.cache_info() for _name, _func in _MEMOIZED.items()}
+
+def invalidate(func=None):
+    # Clears the in-memory and on-disk entries of one memoized function or,
+    # without an argument, of all of them.
+    if func is None:
+        for _func in _MEMOIZED.values():
+            _func.cache_clear()
+    else:
+        func.cache_clear()
@@ -0,0 +1,63 @@
+import logging
+import re
+import subprocess
+import sys
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Import time budgets in seconds for the modules used by headless workers
+BUDGETS = {"single_frequency": .5, "optimal_frequency_distance": .5}
+HEAVY_MODULES = ("matplotlib", "pandas", "scipy.optimize", "scipy.stats",
+                 "scipy.linalg", "sdeint")
+
+
+def measure_import(module, python=sys.executable):
+    # Cumulative import time (in seconds) of the module in a fresh
+    # interpreter, and all modules imported by it
+    proc = subprocess.run([python, "-X", "importtime", "-c", f"import {module}"],
+                          capture_output=True, text=True, check=True)
+    imported = []
+    import_time = None
+    for _line in proc.stderr.splitlines():
+        _match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$", _line)
+        if _match is None:
+            continue
+        imported.append(_match.group(4))
+        if _match.group(4) == module and len(_match.group(3)) == 1:
+            import_time = int(_match.group(2))*1e-6
+    return import_time, imported
+
+def check_import_time(budgets=BUDGETS, num_runs: int = 5):
+    success = True
+    for _module, _budget in budgets.items():
+        _times = []
+        for _run in range(num_runs):
+            _time, _imported = measure_import(_module)
+            _times.append(_time)
+        _time = min(_times)
+        _heavy = sorted({_name for _name in _imported
+                         for _prefix in HEAVY_MODULES
+                         if _name == _prefix or _name.startswith(f"{_prefix}.")})
+        LOGGER.info(f"Import time of {_module}: {_time:.3f} s (budget: {_budget:.3f} s)")
+        if _time > _budget:
+            LOGGER.error(f"Import of {_module} exceeds the budget: {_time:.3f} s > {_budget:.3f} s")
+            success = False
+        if _heavy:
+            LOGGER.error(f"Import of {_module} pulls in heavy modules: {_heavy}")
+            success = False
+    return success
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs="*", default=list(BUDGETS))
+    parser.add_argument("-b", "--budget", type=float, default=None)
+    parser.add_argument("-n", "--num_runs", type=int, default=5)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s - %(module)s -- [%(levelname)8s]: %(message)s",
+                        level=logging.INFO)
+    budgets = {_module: args.budget if args.budget is not None else BUDGETS.get(_module, .5)
+               for _module in args.modules}
+    sys.exit(0 if check_import_time(budgets, num_runs=args.num_runs) else 1)
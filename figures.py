@@ -0,0 +1,128 @@
+import logging
+import os
+import time
+import importlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Each job is given by the target function, its keyword arguments, and the
+# keyword arguments that are filled with the results of other jobs. The
+# parameters are the ones from run.sh.
+JOBS = {
+    "optimal_df": ("optimal_frequency_distance:find_optimal_delta_freq",
+                   {"d_min": 10, "d_max": 100, "freq": 2.4e9, "h_tx": 10, "h_rx": 1.5}, {}),
+    "optimal_df_uav": ("optimal_frequency_distance:find_optimal_delta_freq",
+                       {"d_min": 30, "d_max": 330, "freq": 2.4e9, "h_tx": 10, "h_rx": 3}, {}),
+    "phi_477MHz": ("single_frequency:main_phi",
+                   {"freq": 477134516., "h_tx": 10, "h_rx": 1.5}, {}),
+    "phi_2.4GHz": ("single_frequency:main_phi",
+                   {"freq": 2.4e9, "h_tx": 10, "h_rx": 1.5}, {}),
+    "power_single_477MHz": ("single_frequency:main_power_single_freq",
+                            {"freq": 477134516., "h_tx": 10, "h_rx": 1.5}, {}),
+    "power_single_2.4GHz_rho1": ("single_frequency:main_power_single_freq",
+                                 {"freq": 2.4e9, "h_tx": 10, "h_rx": 1.5, "rho": 1.}, {}),
+    "power_single_2.4GHz_rho.5": ("single_frequency:main_power_single_freq",
+                                  {"freq": 2.4e9, "h_tx": 10, "h_rx": 1.5, "rho": .5}, {}),
+    "power_single_2.4GHz_rho.1": ("single_frequency:main_power_single_freq",
+                                  {"freq": 2.4e9, "h_tx": 10, "h_rx": 1.5, "rho": .1}, {}),
+    "power_two": ("two_frequencies:main_power_two_freq",
+                  {"freq": 2.4e9, "delta_freq": 250e6, "h_tx": 10, "h_rx": 1.5}, {}),
+    "optimization_problem": ("two_frequencies:main_optimization_problem",
+                             {"d_min": 10, "d_max": 100, "freq": 2.4e9, "h_tx": 10, "h_rx": 1.5}, {}),
+    "peaks_100MHz": ("approximation_min_max:main_peaks_approximation",
+                     {"freq": 100e6, "distance": 50, "h_tx": 10, "h_rx": 1.5}, {}),
+    "peaks_2.4GHz": ("approximation_min_max:main_peaks_approximation",
+                     {"freq": 2.4e9, "distance": 50, "h_tx": 10, "h_rx": 1.5}, {}),
+    "optimal_frequency_distance": ("optimal_frequency_distance:main_optimal_frequency_distance",
+                                   {"d_min": 10, "d_max": 100, "freq": 2.4e9, "h_tx": 10, "h_rx": 1.5},
+                                   {"df": "optimal_df"}),
+    "rate_comparison": ("rate_comparison:main_rate_comparison",
+                        {"d_min": 10, "d_max": 100, "freq": 2.4e9, "h_tx": 10, "h_rx": 1.5, "bw": 100e3},
+                        {"df": "optimal_df"}),
+    "outage_probability": ("outage_probability:main_outage_prob_rate",
+                           {"d_min": 10, "d_max": 100, "freq": 2.4e9, "h_tx": 10, "h_rx": 1.5,
+                            "bw": 100e3, "num_samples": int(1e7)},
+                           {"df": "optimal_df"}),
+    "uav": ("uav_example:main",
+            {"freq": 2.4e9, "h_tx": 10, "h_rx": 3, "bw": 100e3, "radius": 150, "num_runs": 1000},
+            {"df": "optimal_df_uav"}),
+    }
+
+# Jobs that only compute intermediate results are called without the
+# plot/export arguments.
+INTERMEDIATE = ("optimal_df", "optimal_df_uav")
+
+
+def _run_job(name, target, kwargs, export, output_dir):
+    _start = time.perf_counter()
+    if output_dir is not None:
+        os.chdir(output_dir)
+    _module, _func = target.split(":")
+    func = getattr(importlib.import_module(_module), _func)
+    if name in INTERMEDIATE:
+        result = func(**kwargs)
+    else:
+        func(**kwargs, export=export)
+        result = None
+    return result, time.perf_counter()-_start
+
+def run_jobs(jobs=JOBS, num_workers: int = None, export=True,
+             output_dir: str = None):
+    if output_dir is not None:
+        output_dir = os.path.abspath(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
+    results = {}
+    wall_times = {}
+    pending = dict(jobs)
+    running = {}
+    _start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        while pending or running:
+            _ready = [_name for _name, (_, _, _deps) in pending.items()
+                      if all(_dep in results for _dep in _deps.values())]
+            for _name in _ready:
+                _target, _kwargs, _deps = pending.pop(_name)
+                _kwargs = dict(_kwargs, **{_arg: results[_dep] for _arg, _dep in _deps.items()})
+                LOGGER.info(f"Starting job: {_name}")
+                running[executor.submit(_run_job, _name, _target, _kwargs,
+                                        export, output_dir)] = _name
+            if not running:
+                raise ValueError(f"Unresolvable dependencies for jobs: {list(pending)}")
+            _done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for _future in _done:
+                _name = running.pop(_future)
+                results[_name], wall_times[_name] = _future.result()
+                LOGGER.info(f"Finished job {_name} in {wall_times[_name]:.2f} s")
+    _total = time.perf_counter()-_start
+    LOGGER.info(f"Finished all jobs in {_total:.2f} s (sum of all jobs: {sum(wall_times.values()):.2f} s)")
+    return results, wall_times
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-j", "--num_workers", type=int, default=None)
+    parser.add_argument("-o", "--output_dir", default=None)
+    parser.add_argument("--jobs", nargs="+", choices=list(JOBS), default=None)
+    parser.add_argument("-v", "--verbosity", action="count", default=0,
+                        help="Increase output verbosity")
+    args = vars(parser.parse_args())
+    verb = args.pop("verbosity")
+    logging.basicConfig(format="%(asctime)s - %(module)s -- [%(levelname)8s]: %(message)s",
+                        handlers=[
+                            logging.FileHandler("main.log", encoding="utf-8"),
+                            logging.StreamHandler()
+                        ])
+    loglevel = logging.WARNING - verb*10
+    LOGGER.setLevel(loglevel)
+    _selected = args.pop("jobs")
+    if _selected is not None:
+        _needed = set(_selected)
+        for _name in _selected:
+            _needed.update(JOBS[_name][2].values())
+        args["jobs"] = {k: v for k, v in JOBS.items() if k in _needed}
+    _, wall_times = run_jobs(**args)
+    for _name, _time in sorted(wall_times.items(), key=lambda x: -x[1]):
+        LOGGER.info(f"Wall time of {_name:30s} {_time:8.2f} s")
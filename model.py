@@ -1,3 +1,5 @@
+import functools
+
 import numpy as np
 
 def length_los(distance, h_tx, h_rx):
@@ -5,3 +7,40 @@ def length_los(distance, h_tx, h_rx):
 
 def length_ref(distance, h_tx, h_rx):
     return np.sqrt(distance**2 + (h_tx+h_rx)**2)
+
+def distance_from_length_diff(length_diff, h_tx, h_rx):
+    # Inverse of length_ref-length_los, which is decreasing in the distance
+    _sum = 4*h_tx*h_rx/length_diff
+    _d_ref = .5*(_sum + length_diff)
+    return np.sqrt(np.maximum(_d_ref**2 - (h_tx+h_rx)**2, 0))
+
+class LinkGeometry:
+    # Path lengths of the direct and the reflected path for an array of
+    # distances. It can be passed instead of the distance to the power and
+    # rate functions, so that several curves share one evaluation of the
+    # geometry. The difference and reciprocals are computed on first use.
+    def __init__(self, distance, h_tx, h_rx):
+        self.distance = distance
+        self.h_tx = h_tx
+        self.h_rx = h_rx
+        self.d_los = length_los(distance, h_tx, h_rx)
+        self.d_ref = length_ref(distance, h_tx, h_rx)
+
+    @functools.cached_property
+    def length_diff(self):
+        return self.d_ref - self.d_los
+
+    @functools.cached_property
+    def inv_d_los(self):
+        return 1./self.d_los
+
+    @functools.cached_property
+    def inv_d_ref(self):
+        return 1./self.d_ref
+
+def link_geometry(distance, h_tx, h_rx):
+    if isinstance(distance, LinkGeometry):
+        if not (np.array_equal(h_tx, distance.h_tx) and np.array_equal(h_rx, distance.h_rx)):
+            raise ValueError(f"The heights h_tx={h_tx}, h_rx={h_rx} do not match the link geometry (h_tx={distance.h_tx}, h_rx={distance.h_rx}).")
+        return distance
+    return LinkGeometry(distance, h_tx, h_rx)
@@ -2,12 +2,12 @@ import logging
 
 import numpy as np
 from scipy import constants
-from scipy import optimize
-import matplotlib.pyplot as plt
 
-from single_frequency import rec_power, min_rec_power_single_freq
-from two_frequencies import sum_power_lower_envelope, delta_freq_peak_approximation
-from util import to_decibel, export_results
+from single_frequency import rec_power, min_rec_power_single_freq, crit_dist
+from two_frequencies import sum_power_lower_envelope, sum_power_lower_envelope_ddf, delta_freq_peak_approximation, min_sum_power
+from util import to_decibel, export_results, newton_bisect_vectorized, adaptive_grid
+from caching import memoize
+from model import LinkGeometry
 
 
 LOGGER = logging.getLogger(__name__)
@@ -22,73 +22,225 @@ def sum_power_d1(delta_freq, freq, h_tx, h_rx, c=constants.c, p_tx=1):
     _part3 = (1/np.sqrt((c**2*np.pi**2 + h_rx*h_tx*domega**2)**2) - 1/np.sqrt((c**2*np.pi**2 - h_rx*h_tx*domega**2)**2))**2
     return _factor * _part1 * _part2 * _part3
 
+def sum_power_d1_ddf(delta_freq, freq, h_tx, h_rx, c=constants.c, p_tx=1):
+    # Derivative of sum_power_d1 with respect to delta_freq
+    omega = 2*np.pi*freq
+    domega = 2*np.pi*delta_freq
+    omega2 = omega + domega
+    _factor = p_tx/2 * (c/2)**2
+    _sum = c**2*np.pi**2 + h_rx*h_tx*domega**2
+    _diff = c**2*np.pi**2 - h_rx*h_tx*domega**2
+    _inner = 1/np.abs(_sum) - 1/np.abs(_diff)
+    _part1 = 1/omega**2 + 1/omega2**2
+    _part2 = c**2 * np.pi**2 * domega**2
+    _part3 = _inner**2
+    # Derivatives with respect to domega
+    _dpart1 = -2/omega2**3
+    _dpart2 = 2*c**2 * np.pi**2 * domega
+    _dinner = -2*h_rx*h_tx*domega*(np.sign(_sum)/_sum**2 + np.sign(_diff)/_diff**2)
+    _dpart3 = 2*_inner*_dinner
+    return 2*np.pi*_factor * (_dpart1*_part2*_part3 + _part1*_dpart2*_part3
+                              + _part1*_part2*_dpart3)
+
+
+def _log_power_difference(d_min, d_max, freq, h_tx, h_rx, g_is_dmin,
+                          c=constants.c):
+    # log(p_max)-log(g_min) and its derivative as functions of x = log10(df).
+    # Both candidates for g_min are only evaluated for arrays of configurations.
+    def _envelope_dmin(delta_freq):
+        return (sum_power_lower_envelope(d_min, delta_freq, freq, h_tx, h_rx, c=c),
+                sum_power_lower_envelope_ddf(d_min, delta_freq, freq, h_tx, h_rx, c=c))
+    def _d1(delta_freq):
+        return (sum_power_d1(delta_freq, freq, h_tx, h_rx, c=c),
+                sum_power_d1_ddf(delta_freq, freq, h_tx, h_rx, c=c))
+    def func(x):
+        delta_freq = 10**x
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p_max = sum_power_lower_envelope(d_max, delta_freq, freq, h_tx, h_rx, c=c)
+            dp_max = sum_power_lower_envelope_ddf(d_max, delta_freq, freq, h_tx, h_rx, c=c)
+            if np.ndim(g_is_dmin) == 0:
+                g_min, dg_min = _envelope_dmin(delta_freq) if g_is_dmin else _d1(delta_freq)
+            else:
+                g_min, dg_min = np.where(g_is_dmin, _envelope_dmin(delta_freq),
+                                         _d1(delta_freq))
+        value = np.log(p_max) - np.log(g_min)
+        derivative = (dp_max/p_max - dg_min/g_min)*delta_freq*np.log(10)
+        return value, derivative
+    return func
+
+def _solve_intersection(func, lower, upper, xtol=1e-12, num_grid=17):
+    # The difference vanishes (numerically) at the upper bound of the second
+    # case, so the bracket is the first sign change on a coarse grid. Without
+    # any sign change, the minimization of the absolute difference ends at
+    # the better bound.
+    _expand = lambda x: np.expand_dims(x, -1)
+    _x_grid = _expand(lower) + _expand(upper-lower)*np.linspace(0, 1, num_grid)
+    _f_grid = func(_x_grid)[0]
+    _changes = np.sign(_f_grid[..., 1:]) != np.sign(_f_grid[..., :1])
+    sign_change = np.any(_changes, axis=-1)
+    _idx = _expand(np.argmax(_changes, axis=-1))
+    opt_x, info = newton_bisect_vectorized(
+            func, np.take_along_axis(_x_grid, _idx, -1),
+            np.take_along_axis(_x_grid, _idx+1, -1), xtol=xtol,
+            full_output=True)
+    _f_lower = _f_grid[..., 0]
+    _f_upper = _f_grid[..., -1]
+    _lower_better = np.abs(_f_lower) < np.abs(_f_upper)
+    opt_x = np.where(sign_change, opt_x[..., 0],
+                     np.where(_lower_better, lower, upper))
+    info = {"iterations": np.where(sign_change, info["iterations"][..., 0], 0),
+            "residual": np.where(sign_change, info["residual"][..., 0],
+                                 np.where(_lower_better, _f_lower, _f_upper)),
+            "converged": sign_change & info["converged"][..., 0]}
+    return opt_x, info
+
 
+@memoize()
 def find_optimal_delta_freq(d_min: float, d_max: float, freq: float, 
                             h_tx: float, h_rx: float,
-                            c: float = constants.speed_of_light):
+                            c: float = constants.speed_of_light,
+                            full_output: bool = False):
+    # With full_output, the number of Newton/bisection iterations, the
+    # residual log(p_max)-log(g_min) at the solution and the convergence flag
+    # are returned together with the frequency spacing.
     if d_max <= d_min:
         raise ValueError("The maximum distance needs to be larger than the minimum distance.")
 
     # Preparation
-    _df_pi_dmin, _df_2pi_dmin = delta_freq_peak_approximation(d_min, h_tx, h_rx)
-    _df_pi_dmax, _df_2pi_dmax = delta_freq_peak_approximation(d_max, h_tx, h_rx)
+    _df_pi_dmin, _df_2pi_dmin = delta_freq_peak_approximation(d_min, h_tx, h_rx, c=c)
+    _df_pi_dmax, _df_2pi_dmax = delta_freq_peak_approximation(d_max, h_tx, h_rx, c=c)
 
-    power_dmax_max = sum_power_lower_envelope(d_max, _df_pi_dmax, freq, h_tx, h_rx)
+    power_dmax_max = sum_power_lower_envelope(d_max, _df_pi_dmax, freq, h_tx, h_rx, c=c)
     if _df_pi_dmax > _df_2pi_dmin:
-        g_dmax_max = sum_power_d1(_df_pi_dmax, freq, h_tx, h_rx)
+        g_dmax_max = sum_power_d1(_df_pi_dmax, freq, h_tx, h_rx, c=c)
     else:
-        g_dmax_max = sum_power_lower_envelope(d_min, _df_pi_dmax, freq, h_tx, h_rx)
+        g_dmax_max = sum_power_lower_envelope(d_min, _df_pi_dmax, freq, h_tx, h_rx, c=c)
     
     # Branch 1: No intersection
     if power_dmax_max < g_dmax_max:
         LOGGER.warn("No intersection between P_r(dmax) and g. Using approximation")
         opt_df = _df_pi_dmax
+        if full_output:
+            return opt_df, {"iterations": 0, "converged": False,
+                            "residual": np.log(power_dmax_max)-np.log(g_dmax_max)}
         return opt_df
 
     # Branch 2: Intersection
-    power_dmax_dmin = sum_power_lower_envelope(d_max, _df_2pi_dmin, freq, h_tx, h_rx)
-    power_dmin_min = sum_power_lower_envelope(d_min, _df_2pi_dmin, freq, h_tx, h_rx)
+    power_dmax_dmin = sum_power_lower_envelope(d_max, _df_2pi_dmin, freq, h_tx, h_rx, c=c)
+    power_dmin_min = sum_power_lower_envelope(d_min, _df_2pi_dmin, freq, h_tx, h_rx, c=c)
     if power_dmax_dmin > power_dmin_min:
         _bounds = [np.log10(_df_pi_dmin), np.log10(_df_2pi_dmin)]
-        g_min = lambda x: sum_power_lower_envelope(d_min, 10**x, freq, h_tx, h_rx)
     else:
         _bounds = [np.log10(_df_2pi_dmin), np.log10(_df_2pi_dmax)]
-        g_min = lambda x: sum_power_d1(10**x, freq, h_tx, h_rx)
-    p_max = lambda x: sum_power_lower_envelope(d_max, 10**x, freq, h_tx, h_rx)
-    func_opt = lambda x: np.abs(np.log(p_max(x))-np.log(g_min(x)))
-    opt = optimize.minimize(func_opt, x0=np.mean(_bounds),
-                            bounds=optimize.Bounds(*_bounds))
-    opt_df = 10**opt.x[0]
+    func_root = _log_power_difference(d_min, d_max, freq, h_tx, h_rx,
+                                      power_dmax_dmin > power_dmin_min, c=c)
+    opt_x, info = _solve_intersection(func_root, *_bounds)
+    opt_df = 10**float(opt_x)
+    LOGGER.debug(f"Intersection after {info['iterations']:d} iterations (residual: {float(info['residual']):.2E})")
+    if full_output:
+        return opt_df, {"iterations": int(info["iterations"]),
+                        "converged": bool(info["converged"]),
+                        "residual": float(info["residual"])}
+    return opt_df
+
+def find_optimal_delta_freq_batch(d_min, d_max, freq, h_tx, h_rx,
+                                  c: float = constants.speed_of_light,
+                                  xtol: float = 1e-12, num_grid: int = 17,
+                                  full_output: bool = False):
+    # Array version of find_optimal_delta_freq. All parameters are broadcast
+    # against each other and the intersection is found by the same
+    # safeguarded Newton iteration.
+    d_min, d_max, freq, h_tx, h_rx = np.broadcast_arrays(
+            *[np.asarray(_x, dtype=float) for _x in (d_min, d_max, freq, h_tx, h_rx)])
+    if np.any(d_max <= d_min):
+        raise ValueError("The maximum distance needs to be larger than the minimum distance.")
+
+    # Preparation
+    _df_dmin = delta_freq_peak_approximation(np.expand_dims(d_min, -1),
+                                             np.expand_dims(h_tx, -1),
+                                             np.expand_dims(h_rx, -1), c=c)
+    _df_dmax = delta_freq_peak_approximation(np.expand_dims(d_max, -1),
+                                             np.expand_dims(h_tx, -1),
+                                             np.expand_dims(h_rx, -1), c=c)
+    _df_pi_dmin, _df_2pi_dmin = _df_dmin[..., 0], _df_dmin[..., 1]
+    _df_pi_dmax, _df_2pi_dmax = _df_dmax[..., 0], _df_dmax[..., 1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        power_dmax_max = sum_power_lower_envelope(d_max, _df_pi_dmax, freq, h_tx, h_rx, c=c)
+        g_dmax_max = np.where(_df_pi_dmax > _df_2pi_dmin,
+                              sum_power_d1(_df_pi_dmax, freq, h_tx, h_rx, c=c),
+                              sum_power_lower_envelope(d_min, _df_pi_dmax, freq, h_tx, h_rx, c=c))
+    no_intersection = power_dmax_max < g_dmax_max
+    if np.any(no_intersection):
+        LOGGER.warning("No intersection between P_r(dmax) and g for %d configurations. Using approximation",
+                       np.count_nonzero(no_intersection))
+
+    # Intersection (evaluated for all configurations and replaced afterwards)
+    power_dmax_dmin = sum_power_lower_envelope(d_max, _df_2pi_dmin, freq, h_tx, h_rx, c=c)
+    power_dmin_min = sum_power_lower_envelope(d_min, _df_2pi_dmin, freq, h_tx, h_rx, c=c)
+    g_is_dmin = power_dmax_dmin > power_dmin_min
+    _lower = np.log10(np.where(g_is_dmin, _df_pi_dmin, _df_2pi_dmin))
+    _upper = np.log10(np.where(g_is_dmin, _df_2pi_dmin, _df_2pi_dmax))
+
+    # All functions of x = log10(df) carry a trailing axis for the search grid
+    _expand = lambda x: np.expand_dims(x, -1)
+    func_root = _log_power_difference(*map(_expand, (d_min, d_max, freq,
+                                                     h_tx, h_rx, g_is_dmin)),
+                                      c=c)
+    opt_x, info = _solve_intersection(func_root, _lower, _upper, xtol=xtol,
+                                      num_grid=num_grid)
+    opt_df = np.where(no_intersection, _df_pi_dmax, 10**opt_x)
+    if full_output:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _residual = np.log(power_dmax_max) - np.log(g_dmax_max)
+        info = {"iterations": np.where(no_intersection, 0, info["iterations"]),
+                "converged": ~no_intersection & info["converged"],
+                "residual": np.where(no_intersection, _residual, info["residual"])}
+        return opt_df, info
     return opt_df
 
 def main_optimal_frequency_distance(d_min: float, d_max: float, freq: float, 
                                     h_tx: float, h_rx: float,
                                     c: float = constants.speed_of_light,
+                                    df: float = None, tol_db: float = .25,
                                     plot=False, export=False):
 
-    distance = np.logspace(np.log10(d_min)-.1, np.log10(d_max)+.1, 3000)
-    power_rx_single = rec_power(distance, freq, h_tx, h_rx)
-    power_rx_single_db = to_decibel(power_rx_single)
     min_power_single = min_rec_power_single_freq(d_min, d_max, freq, h_tx, h_rx)
     min_power_single_db = to_decibel(min_power_single)
     LOGGER.info(f"Minimum power single frequency: {min_power_single_db:.2f} dB")
 
-    opt_df = find_optimal_delta_freq(d_min, d_max, freq, h_tx, h_rx, c)
+    if df is None:
+        opt_df = find_optimal_delta_freq(d_min, d_max, freq, h_tx, h_rx, c)
+    else:
+        opt_df = df
     LOGGER.info(f"Optimal frequency spacing: {opt_df:E}")
-    power_rx_opt = sum_power_lower_envelope(distance, opt_df, freq, h_tx, h_rx)
-    power_rx_opt_db = to_decibel(power_rx_opt)
     min_power_two = sum_power_lower_envelope(d_max, opt_df, freq, h_tx, h_rx)
     min_power_two_db = to_decibel(min_power_two)
     LOGGER.info(f"Minimum power two frequencies: {min_power_two_db:.2f} dB")
+    min_power_two_exact = min_sum_power(d_min, d_max, opt_df, freq, h_tx, h_rx, c=c)
+    LOGGER.info(f"Minimum power two frequencies (exact): {to_decibel(min_power_two_exact):.2f} dB")
 
-    power_rx_opt_exact = .5*(power_rx_single + rec_power(distance, freq+opt_df, h_tx, h_rx))
-    power_rx_opt_exact_db = to_decibel(power_rx_opt_exact)
+    def _power_curves(distance):
+        geometry = LinkGeometry(distance, h_tx, h_rx)
+        power_rx_single = rec_power(geometry, freq, h_tx, h_rx)
+        power_rx_opt = sum_power_lower_envelope(geometry, opt_df, freq, h_tx, h_rx)
+        power_rx_opt_exact = .5*(power_rx_single + rec_power(geometry, freq+opt_df, h_tx, h_rx))
+        return np.stack([power_rx_single, power_rx_opt, power_rx_opt_exact])
+    # Nulls of both carriers and minima of the lower envelope
+    _anchors = np.concatenate([crit_dist(freq, h_tx, h_rx),
+                               crit_dist(freq+opt_df, h_tx, h_rx),
+                               crit_dist(opt_df, h_tx, h_rx), [d_min, d_max]])
+    distance, _powers = adaptive_grid(_power_curves, 10**(np.log10(d_min)-.1),
+                                      10**(np.log10(d_max)+.1),
+                                      anchors=_anchors, tol_db=tol_db)
+    power_rx_single_db, power_rx_opt_db, power_rx_opt_exact_db = to_decibel(_powers)
 
     results = {"distance": distance, "powerSingle": power_rx_single_db,
                "powerOpt": power_rx_opt_db,
                "powerOptExact": power_rx_opt_exact_db}
 
     if plot:
+        import matplotlib.pyplot as plt
         fig, axs = plt.subplots()
         axs.semilogx(distance, power_rx_single_db, '-b', label="Single Frequency")
         axs.semilogx(distance, power_rx_opt_db, '-r', label="Lower Bound")
@@ -102,12 +254,14 @@ def main_optimal_frequency_distance(d_min: float, d_max: float, freq: float,
 
 if __name__ == "__main__":
     import argparse
+    import matplotlib.pyplot as plt
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--h_tx", type=float, default=10.)
     parser.add_argument("-r", "--h_rx", type=float, default=1.)
     parser.add_argument("-f", "--freq", type=float, default=2.4e9)
     parser.add_argument("-dmin", "--d_min", type=float, default=10.)
     parser.add_argument("-dmax", "--d_max", type=float, default=100.)
+    parser.add_argument("--tol_db", type=float, default=.25)
     parser.add_argument("--plot", action="store_true")
     parser.add_argument("--export", action="store_true")
     parser.add_argument("-v", "--verbosity", action="count", default=0,
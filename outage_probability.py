@@ -1,15 +1,17 @@
+import functools
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 from scipy import constants
-from scipy import stats
-import matplotlib.pyplot as plt
 
-from single_frequency import rec_power
+from single_frequency import rec_power, crit_dist
 from two_frequencies import sum_power_lower_envelope
-from optimal_frequency_distance import find_optimal_delta_freq
-from rate_comparison import rate_single_freq, rate_two_freq, rate_two_freq_lower
-from util import export_results, to_decibel
+from optimal_frequency_distance import find_optimal_delta_freq, find_optimal_delta_freq_batch
+from rate_comparison import rate_single_freq, rate_two_freq, rate_two_freq_lower, rate_curves
+from model import length_los, length_ref, distance_from_length_diff
+from util import export_results, to_decibel, bisect_vectorized, minimize_scalar_vectorized, ResultsWriter
+from rate_histogram import RateHistogram
 
 
 LOGGER = logging.getLogger(__name__)
@@ -17,29 +19,249 @@ LOGGER = logging.getLogger(__name__)
 def outage_prob_mc(rates, threshold=None):
     if threshold is None:
         threshold = np.logspace(4, 10, 2000)
-    rates = {k: np.expand_dims(_p, 1) for k, _p in rates.items()}
     LOGGER.debug("Estimate outage probabilities... (This might take a while...)")
     #results = {k: np.count_nonzero(_rate < threshold, axis=0)/num_samples
-    results = {k: np.count_nonzero(_rate < threshold, axis=0)/len(_rate)
+    results = {k: _count/len(rates[k])
+               for k, _count in _outage_counts(rates, threshold).items()}
+    return results
+
+def _outage_counts(rates, threshold):
+    results = {k: np.searchsorted(np.sort(_rate), threshold, side='left')
                for k, _rate in rates.items()}
     return results
 
+class EmpiricalCDF:
+    # Exact empirical CDF P(X < x) of the samples, based on sorting. With
+    # max_prob, only the lower tail up to this probability is kept via a
+    # partial selection and the CDF is NaN above it.
+    def __init__(self, samples, max_prob: float = None):
+        samples = np.ravel(samples)
+        self.num_samples = len(samples)
+        if max_prob is not None and max_prob < 1:
+            _k = min(self.num_samples, int(np.ceil(max_prob*self.num_samples))+1)
+            samples = np.partition(samples, _k-1)[:_k]
+        self.sorted_samples = np.sort(samples)
+
+    def cdf(self, x):
+        counts = np.searchsorted(self.sorted_samples, x, side='left')
+        prob = counts/self.num_samples
+        if len(self.sorted_samples) < self.num_samples:
+            prob = np.where(counts < len(self.sorted_samples), prob, np.nan)
+        return prob
+
+    def quantile(self, eps):
+        # Smallest sample x with P(X <= x) >= eps, i.e., the inverse of the
+        # empirical CDF. Quantiles above max_prob are NaN.
+        _idx = np.ceil(np.round(np.asarray(eps, dtype=float)*self.num_samples, 6))
+        _idx = np.maximum(_idx.astype(int)-1, 0)
+        _valid = _idx < len(self.sorted_samples)
+        _idx = np.minimum(_idx, len(self.sorted_samples)-1)
+        return np.where(_valid, self.sorted_samples[_idx], np.nan)
+
+class UniformDistanceCDF:
+    # Exact CDF P(rate_func(D) < x) for D uniformly distributed in
+    # [d_min, d_max]. The interval is split at the extrema of the rate into
+    # monotone pieces and the level crossings on each piece are found by a
+    # bisection that is vectorized over all thresholds. The extrema are
+    # bracketed on a grid that is uniform in the phase 2*pi*max_freq/c*(d_ref-d_los).
+    def __init__(self, rate_func, d_min, d_max, max_freq, h_tx, h_rx,
+                 phase_step=np.pi/16, num_points=200, xtol=1e-10,
+                 c=constants.c):
+        self.rate_func = rate_func
+        self.d_min = d_min
+        self.d_max = d_max
+        self.xtol = xtol
+        _diff_min = length_ref(d_max, h_tx, h_rx) - length_los(d_max, h_tx, h_rx)
+        _diff_max = length_ref(d_min, h_tx, h_rx) - length_los(d_min, h_tx, h_rx)
+        _num_phase = int(np.ceil(2*np.pi*max_freq/c*(_diff_max-_diff_min)/phase_step))
+        _distance_phase = distance_from_length_diff(
+                np.linspace(_diff_min, _diff_max, _num_phase+2), h_tx, h_rx)
+        distance = np.unique(np.clip(np.concatenate(
+            [_distance_phase, np.geomspace(d_min, d_max, num_points)]), d_min, d_max))
+        values = rate_func(distance)
+
+        _slope = np.sign(np.diff(values))
+        _idx = np.where(_slope[1:]*_slope[:-1] < 0)[0] + 1
+        _sign = np.where(_slope[_idx-1] < 0, 1., -1.)
+        extrema, _ = minimize_scalar_vectorized(lambda x: _sign*rate_func(x),
+                                                distance[_idx-1],
+                                                distance[_idx+1], xtol=xtol)
+        _bounds = np.concatenate([[d_min], np.sort(extrema), [d_max]])
+        _values = rate_func(_bounds)
+        self.lower = _bounds[:-1]
+        self.upper = _bounds[1:]
+        self.value_lower = _values[:-1]
+        self.value_upper = _values[1:]
+        LOGGER.debug(f"Split the distance interval into {len(self.lower):d} monotone pieces")
+
+    def cdf(self, x):
+        x = np.asarray(x, dtype=float)
+        _threshold = np.ravel(x)
+        _min = np.minimum(self.value_lower, self.value_upper)[:, None]
+        _max = np.maximum(self.value_lower, self.value_upper)[:, None]
+        _full = _threshold >= _max
+        length = np.sum(_full*(self.upper-self.lower)[:, None], axis=0)
+
+        _seg, _thr = np.nonzero(np.logical_and(_threshold > _min, _threshold < _max))
+        _crossing = bisect_vectorized(lambda d: self.rate_func(d) - _threshold[_thr],
+                                      self.lower[_seg], self.upper[_seg],
+                                      xtol=self.xtol)
+        _increasing = self.value_upper[_seg] > self.value_lower[_seg]
+        _part = np.where(_increasing, _crossing - self.lower[_seg],
+                         self.upper[_seg] - _crossing)
+        length = length + np.bincount(_thr, weights=_part, minlength=len(_threshold))
+        prob = length/(self.d_max-self.d_min)
+        return np.reshape(prob, x.shape)
+
+    def quantile(self, eps, xtol=1e-12):
+        # Inverse of the CDF by a bisection in the logarithm of the rate, which
+        # is vectorized over eps
+        eps = np.asarray(eps, dtype=float)
+        _values = np.concatenate([self.value_lower, self.value_upper])
+        _lower = np.full(eps.shape, np.log(np.min(_values)))
+        _upper = np.full(eps.shape, np.log(np.max(_values)))
+        log_rate = bisect_vectorized(lambda x: self.cdf(np.exp(x)) - eps,
+                                     _lower, _upper, xtol=xtol)
+        return np.exp(log_rate)
+
+def analytic_rate_cdf(d_min, d_max, freq, h_tx, h_rx, bw, df,
+                      noise_fig_db: float = 3, noise_den_db: float = -174):
+    _kwargs = {"noise_fig_db": noise_fig_db, "noise_den_db": noise_den_db}
+    rate_funcs = {
+        "singleActual": (lambda d: rate_single_freq(d, freq, h_tx, h_rx, bw, **_kwargs), freq),
+        "twoActual": (lambda d: rate_two_freq(d, freq, df, h_tx, h_rx, bw, **_kwargs), freq+df),
+        "twoLower": (lambda d: rate_two_freq_lower(d, freq, df, h_tx, h_rx, bw, d_max=d_max, **_kwargs), df),
+        }
+    rates_cdf = {k: UniformDistanceCDF(_func, d_min, d_max, _max_freq, h_tx, h_rx)
+                 for k, (_func, _max_freq) in rate_funcs.items()}
+    return rates_cdf
+
+def outage_rate(eps, d_min, d_max, freq, h_tx, h_rx, bw, df=None,
+                noise_fig_db: float = 3, noise_den_db: float = -174,
+                method: str = "analytic", num_samples: int = int(1e6),
+                estimator: str = "exact", rng=None):
+    # Rate that is achieved with probability 1-eps (eps-outage rate) for a
+    # uniformly distributed distance. The link parameters are broadcast and
+    # the results have their shape followed by the shape of eps. Without df,
+    # the optimal frequency spacing of each configuration is used. The
+    # analytic method inverts the exact CDF, while the mc method selects the
+    # order statistics of num_samples random distances. The mc method
+    # evaluates the rates of all configurations in one call of rate_curves
+    # (with the samples along the last axis, i.e., three arrays of
+    # num_samples values per configuration).
+    if method not in ("analytic", "mc"):
+        raise ValueError(f"Unknown method: {method}")
+    if estimator not in ("exact", "histogram"):
+        raise ValueError(f"Unknown estimator: {estimator}")
+    if rng is None:
+        rng = np.random.default_rng()
+    eps = np.asarray(eps, dtype=float)
+    params = np.broadcast_arrays(*[np.asarray(_x, dtype=float) for _x in
+                                   (d_min, d_max, freq, h_tx, h_rx, bw)])
+    if df is None:
+        df = find_optimal_delta_freq_batch(*params[:5])
+    df = np.broadcast_to(df, params[0].shape)
+    if method == "mc":
+        _d_min, _d_max, _freq, _h_tx, _h_rx, _bw, _df = [
+                np.expand_dims(_p, -1) for _p in (*params, df)]
+        distance = rng.uniform(_d_min, _d_max, params[0].shape + (num_samples,))
+        rates = dict(zip(("singleActual", "twoActual", "twoLower"), rate_curves(
+                distance, _freq, _df, _h_tx, _h_rx, _bw, d_max=_d_max,
+                noise_fig_db=noise_fig_db, noise_den_db=noise_den_db)))
+        _max_prob = np.max(eps) if estimator == "exact" else None
+    results = {}
+    # The monotone pieces of the rates differ between the configurations, so
+    # the analytic CDF is built per configuration and only the inversion for
+    # all eps is vectorized.
+    for _idx in np.ndindex(params[0].shape):
+        if method == "analytic":
+            _d_min, _d_max, _freq, _h_tx, _h_rx, _bw = [float(_p[_idx]) for _p in params]
+            rate_cdf = analytic_rate_cdf(_d_min, _d_max, _freq, _h_tx, _h_rx,
+                                         _bw, float(df[_idx]), noise_fig_db,
+                                         noise_den_db)
+        elif estimator == "exact":
+            rate_cdf = {k: EmpiricalCDF(v[_idx], max_prob=_max_prob)
+                        for k, v in rates.items()}
+        else:
+            rate_cdf = {k: RateHistogram().update(v[_idx])
+                        for k, v in rates.items()}
+        for _name, _cdf in rate_cdf.items():
+            if _name not in results:
+                results[_name] = np.empty(params[0].shape + eps.shape)
+            results[_name][_idx] = _cdf.quantile(eps)
+    return results
+
 def main_outage_prob_rate(d_min, d_max, freq, h_tx, h_rx, bw, df: float = None,
                           noise_fig_db: float = 3, noise_den_db: float = -174,
                           c=constants.c, num_samples=100000,
+                          chunk_size: int = None, max_prob: float = None,
+                          method: str = "mc", sample_file: str = None,
+                          single_precision: bool = False,
+                          num_workers: int = None, seed: int = None,
+                          estimator: str = "exact",
+                          target_prob: float = 1e-5, rel_precision: float = .1,
+                          interval: str = "wilson", sobol: bool = False,
                           plot=False, export=False, **kwargs):
     LOGGER.info(f"Simulating outage probability with parameters: f1={freq:E}, h_tx={h_tx:.1f}, h_rx={h_rx:.1f}, dmin={d_min:.1f}, dmax={d_max:.1f}")
     LOGGER.info(f"Number of samples: {num_samples:E}")
-    distance = (d_max-d_min)*np.random.rand(num_samples) + d_min
     if df is None:
         df = find_optimal_delta_freq(d_min, d_max, freq, h_tx, h_rx)
 
-    rate_rv = _generate_rate_rv(distance, d_max, freq, h_tx, h_rx, bw, df,
-                                noise_fig_db, noise_den_db)
     threshold = np.logspace(4, 10, 2000)
-    results = {k: v.cdf(threshold) for k, v in rate_rv.items()}
+    dtype = np.float32 if single_precision else np.float64
+    confidence = {}
+    if method == "importance":
+        results, confidence = outage_prob_importance(
+                d_min, d_max, freq, h_tx, h_rx, bw, df, threshold,
+                num_samples, noise_fig_db=noise_fig_db,
+                noise_den_db=noise_den_db, rng=np.random.default_rng(seed),
+                chunk_size=chunk_size, dtype=dtype)
+    elif method == "sequential":
+        # The number of samples is the maximum in the sequential mode
+        _batch_size = {} if chunk_size is None else {"batch_size": chunk_size}
+        results, confidence, _info = outage_prob_sequential(
+                d_min, d_max, freq, h_tx, h_rx, bw, df, threshold,
+                target_prob=target_prob, rel_precision=rel_precision,
+                max_samples=num_samples, interval=interval, sobol=sobol,
+                noise_fig_db=noise_fig_db, noise_den_db=noise_den_db,
+                rng=np.random.default_rng(seed), dtype=dtype, **_batch_size)
+    elif method == "analytic":
+        rate_cdf = analytic_rate_cdf(d_min, d_max, freq, h_tx, h_rx, bw, df,
+                                     noise_fig_db, noise_den_db)
+        results = {k: v.cdf(threshold) for k, v in rate_cdf.items()}
+    elif method != "mc":
+        raise ValueError(f"Unknown method: {method}")
+    elif num_workers is not None or seed is not None:
+        if sample_file is not None:
+            LOGGER.warning("Samples are not written in the parallel mode.")
+        _block_size = {} if chunk_size is None else {"block_size": chunk_size}
+        counts, _num = outage_counts_parallel(
+                d_min, d_max, freq, h_tx, h_rx, bw, df, threshold,
+                num_samples, seed=seed, num_workers=num_workers,
+                noise_fig_db=noise_fig_db, noise_den_db=noise_den_db,
+                dtype=dtype, estimator=estimator, **_block_size)
+        if estimator == "histogram":
+            results = {k: v.cdf(threshold) for k, v in counts.items()}
+        else:
+            results = {k: v/_num for k, v in counts.items()}
+    elif chunk_size is None:
+        if sample_file is not None:
+            LOGGER.warning("Samples are only written in the streaming mode (chunk_size).")
+        distance = (d_max-d_min)*np.random.rand(num_samples) + d_min
+        rate_rv = _generate_rate_rv(distance, d_max, freq, h_tx, h_rx, bw, df,
+                                    noise_fig_db, noise_den_db,
+                                    max_prob=max_prob, dtype=dtype,
+                                    estimator=estimator)
+        results = {k: v.cdf(threshold) for k, v in rate_rv.items()}
+    else:
+        results = _outage_prob_streaming(d_min, d_max, freq, h_tx, h_rx, bw,
+                                         df, threshold, num_samples,
+                                         chunk_size, noise_fig_db,
+                                         noise_den_db, sample_file=sample_file,
+                                         dtype=dtype, estimator=estimator)
 
     if plot:
+        import matplotlib.pyplot as plt
         fig, axs = plt.subplots()
         for _name, _prob in results.items():
             axs.loglog(threshold, _prob, label=_name)
@@ -47,35 +269,356 @@ def main_outage_prob_rate(d_min, d_max, freq, h_tx, h_rx, bw, df: float = None,
         axs.set_ylabel("Outage Probability $\\varepsilon$")
         axs.legend()
 
+    for _name, (_lower, _upper) in confidence.items():
+        results[f"{_name}Lower"] = _lower
+        results[f"{_name}Upper"] = _upper
     results['threshold'] = threshold
     if export:
         LOGGER.info("Exporting results.")
         export_results(results, f"out_prob_rate-{freq:E}-dmin{d_min:.1f}-dmax{d_max:.1f}-t{h_tx:.1f}-r{h_rx:.1f}-bw{bw:E}.dat")
     return results
 
-def _generate_rate_rv(distance, d_max, freq, h_tx, h_rx, bw, df,
-                      noise_fig_db: float = 3, noise_den_db: float = -174,
-                      c=constants.c):
-    LOGGER.debug("Work on single frequency scenario...")
-    rate_single = rate_single_freq(distance, freq, h_tx, h_rx, bw,
-                                   noise_fig_db=noise_fig_db,
-                                   noise_den_db=noise_den_db)
-    
-    LOGGER.info(f"Frequency spacing: {df:E}")
-    LOGGER.debug("Work on two frequency scenario...")
-    rate_two = rate_two_freq(distance, freq, df, h_tx, h_rx, bw,
-                             noise_fig_db=noise_fig_db,
-                             noise_den_db=noise_den_db)
-    LOGGER.debug("Work on two frequency scenario (lower bound)...")
-    rate_two_lower =  rate_two_freq_lower(distance, freq, df, h_tx, h_rx,
-                                          bw=bw, d_max=d_max,
-                                          noise_fig_db=noise_fig_db,
-                                          noise_den_db=noise_den_db)
+def _outage_prob_streaming(d_min, d_max, freq, h_tx, h_rx, bw, df, threshold,
+                           num_samples, chunk_size,
+                           noise_fig_db: float = 3, noise_den_db: float = -174,
+                           sample_file: str = None, dtype=np.float64,
+                           estimator: str = "exact"):
+    # Peak memory is set by chunk_size, since only the counts of rates below
+    # each threshold (or the rate histograms) are kept between the chunks and
+    # the rates of each chunk are written into the same buffers. The raw
+    # samples can be dumped chunk by chunk to sample_file.
+    if estimator not in ("exact", "histogram"):
+        raise ValueError(f"Unknown estimator: {estimator}")
+    LOGGER.info(f"Streaming mode with chunks of {chunk_size:d} samples")
+    writer = None
+    if sample_file is not None:
+        LOGGER.info(f"Writing the samples to: {sample_file}")
+        writer = ResultsWriter(sample_file)
+    counts = None
+    _buffers = [np.empty(min(chunk_size, num_samples), dtype=dtype) for _ in range(3)]
+    _num_done = 0
+    while _num_done < num_samples:
+        _num_chunk = min(chunk_size, num_samples-_num_done)
+        distance = (d_max-d_min)*np.random.rand(_num_chunk) + d_min
+        rates = _generate_rates(distance, d_max, freq, h_tx, h_rx, bw, df,
+                                noise_fig_db, noise_den_db, dtype=dtype,
+                                out=[_buf[:_num_chunk] for _buf in _buffers])
+        if writer is not None:
+            writer.append(dict(distance=distance, **rates))
+        if estimator == "histogram":
+            if counts is None:
+                counts = {k: RateHistogram() for k in rates}
+            for _name, _rates in rates.items():
+                counts[_name].update(_rates)
+        else:
+            _counts = _outage_counts(rates, threshold)
+            if counts is None:
+                counts = _counts
+            else:
+                counts = {k: counts[k] + _counts[k] for k in counts}
+        _num_done = _num_done + _num_chunk
+        LOGGER.debug(f"Completed {_num_done:d}/{num_samples:d} samples")
+    if writer is not None:
+        writer.close()
+    if estimator == "histogram":
+        return {k: v.cdf(threshold) for k, v in counts.items()}
+    results = {k: v/num_samples for k, v in counts.items()}
+    return results
 
+def _outage_counts_block(seed_seq, num_samples, d_min, d_max, freq, h_tx,
+                         h_rx, bw, df, threshold, noise_fig_db: float = 3,
+                         noise_den_db: float = -174, dtype=np.float64,
+                         estimator: str = "exact"):
+    rng = np.random.default_rng(seed_seq)
+    distance = rng.uniform(d_min, d_max, num_samples)
+    rates = _generate_rates(distance, d_max, freq, h_tx, h_rx, bw, df,
+                            noise_fig_db, noise_den_db, dtype=dtype)
+    if estimator == "histogram":
+        return {k: RateHistogram().update(v) for k, v in rates.items()}
+    return _outage_counts(rates, threshold)
+
+def outage_counts_parallel(d_min, d_max, freq, h_tx, h_rx, bw, df, threshold,
+                           num_samples, seed=None, num_workers: int = None,
+                           block_size: int = 2**20, blocks=None,
+                           noise_fig_db: float = 3, noise_den_db: float = -174,
+                           dtype=np.float64, estimator: str = "exact"):
+    # The samples are split into blocks of block_size and block i draws its
+    # distances from the i-th child of SeedSequence(seed). Since the blocks do
+    # not depend on the number of workers and only the integer counts below
+    # each threshold (or the integer histogram counts) are merged, the results
+    # are identical for any num_workers. Disjoint ranges of blocks can be
+    # evaluated separately (e.g., on multiple machines) and their counts added.
+    # Returns the counts, or the merged RateHistogram of each scheme for
+    # estimator="histogram", and the number of evaluated samples.
+    if estimator not in ("exact", "histogram"):
+        raise ValueError(f"Unknown estimator: {estimator}")
+    seed_seq = np.random.SeedSequence(seed)
+    if seed is None:
+        LOGGER.info(f"Seed entropy: {seed_seq.entropy}")
+    num_blocks = -(-num_samples//block_size)
+    children = seed_seq.spawn(num_blocks)
+    if blocks is None:
+        blocks = range(num_blocks)
+    _sizes = [min(block_size, num_samples-_idx*block_size) for _idx in blocks]
+    _children = [children[_idx] for _idx in blocks]
+    _block = functools.partial(_outage_counts_block, d_min=d_min, d_max=d_max,
+                               freq=freq, h_tx=h_tx, h_rx=h_rx, bw=bw, df=df,
+                               threshold=threshold, noise_fig_db=noise_fig_db,
+                               noise_den_db=noise_den_db, dtype=dtype,
+                               estimator=estimator)
+    LOGGER.info(f"Evaluating {len(_sizes):d} blocks of up to {block_size:d} samples")
+    counts = {}
+
+    def _merge(_counts):
+        for _name, _value in _counts.items():
+            if _name not in counts:
+                counts[_name] = _value
+            elif estimator == "histogram":
+                counts[_name].merge(_value)
+            else:
+                counts[_name] = counts[_name] + _value
+
+    if num_workers == 1:
+        for _counts in map(_block, _children, _sizes):
+            _merge(_counts)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for _counts in executor.map(_block, _children, _sizes):
+                _merge(_counts)
+    return counts, sum(_sizes)
+
+def binomial_interval(counts, num_samples, confidence: float = .95,
+                      method: str = "wilson"):
+    # Two-sided confidence interval of a probability from the number of
+    # samples below the threshold. The Clopper-Pearson interval is exact
+    # (conservative), the Wilson score interval is shorter and closed-form.
+    from scipy import stats
+    counts = np.asarray(counts)
+    _alpha = 1 - confidence
+    if method == "wilson":
+        z = stats.norm.ppf(1 - _alpha/2)
+        _prob = counts/num_samples
+        _denom = 1 + z**2/num_samples
+        _center = (_prob + z**2/(2*num_samples))/_denom
+        _half = z*np.sqrt(_prob*(1-_prob)/num_samples + z**2/(4*num_samples**2))/_denom
+        return np.maximum(_center-_half, 0), np.minimum(_center+_half, 1)
+    elif method == "clopper-pearson":
+        with np.errstate(invalid='ignore'):
+            lower = stats.beta.ppf(_alpha/2, counts, num_samples-counts+1)
+            upper = stats.beta.ppf(1-_alpha/2, counts+1, num_samples-counts)
+        return (np.where(counts == 0, 0., lower),
+                np.where(counts == num_samples, 1., upper))
+    raise ValueError(f"Unknown interval method: {method}")
+
+def _relative_precision(prob, interval, target_prob):
+    # Relative half-width of the interval at the first threshold whose
+    # estimated outage probability reaches target_prob
+    _idx = np.searchsorted(prob, target_prob, side='left')
+    if _idx == len(prob):
+        return np.inf
+    lower, upper = interval
+    return .5*(upper[_idx]-lower[_idx])/prob[_idx]
+
+def outage_prob_sequential(d_min, d_max, freq, h_tx, h_rx, bw, df, threshold,
+                           target_prob: float = 1e-5, rel_precision: float = .1,
+                           max_samples: int = int(1e8), batch_size: int = 2**16,
+                           confidence: float = .95, interval: str = "wilson",
+                           sobol: bool = False, noise_fig_db: float = 3,
+                           noise_den_db: float = -174, rng=None,
+                           dtype=np.float64):
+    # Batches of samples are drawn until the relative half-width of the
+    # confidence interval at the outage level target_prob is below
+    # rel_precision for all rates, or until max_samples are used. With
+    # sobol, the distances are the points of a scrambled Sobol sequence. The
+    # binomial intervals are then conservative, since the error of the
+    # quasi-random estimate is typically smaller than for independent samples.
+    # Each aligned block of 2^m Sobol points is balanced, so the batch size is
+    # rounded up to a power of two (at most max_samples) and max_samples down
+    # to whole batches.
+    # Returns the outage probabilities, the confidence intervals, and the
+    # number of used samples with the achieved precisions.
+    if rng is None:
+        rng = np.random.default_rng()
+    if sobol:
+        from scipy.stats import qmc
+        sampler = qmc.Sobol(d=1, scramble=True, rng=rng)
+        _m = min(int(np.ceil(np.log2(batch_size))),
+                 int(np.floor(np.log2(max_samples))))
+        if 2**_m != batch_size:
+            LOGGER.info(f"Using batches of {2**_m:d} samples for the Sobol sequence")
+            batch_size = 2**_m
+        if max_samples % batch_size:
+            max_samples = max_samples - max_samples % batch_size
+            LOGGER.info(f"Rounding the maximum number of samples down to {max_samples:d} for the Sobol sequence")
+    counts = None
+    num_samples = 0
+    while num_samples < max_samples:
+        _num_batch = min(batch_size, max_samples-num_samples)
+        if sobol:
+            # random_base2 would require the total number of points to be a
+            # power of two, which only holds for doubling batches.
+            _uniform = sampler.random(_num_batch)[:, 0]
+        else:
+            _uniform = rng.random(_num_batch)
+        distance = (d_max-d_min)*_uniform + d_min
+        rates = _generate_rates(distance, d_max, freq, h_tx, h_rx, bw, df,
+                                noise_fig_db, noise_den_db, dtype=dtype)
+        _counts = _outage_counts(rates, threshold)
+        if counts is None:
+            counts = _counts
+        else:
+            counts = {k: counts[k] + _counts[k] for k in counts}
+        num_samples = num_samples + _num_batch
+        intervals = {k: binomial_interval(v, num_samples, confidence, interval)
+                     for k, v in counts.items()}
+        precision = {k: _relative_precision(v/num_samples, intervals[k], target_prob)
+                     for k, v in counts.items()}
+        LOGGER.debug(f"Relative precision after {num_samples:d} samples: {precision}")
+        if all(_prec <= rel_precision for _prec in precision.values()):
+            break
+    converged = all(_prec <= rel_precision for _prec in precision.values())
+    if not converged:
+        LOGGER.warning(f"The relative precision {rel_precision:.2E} was not reached with {max_samples:d} samples.")
+    LOGGER.info(f"Used {num_samples:d} samples. Relative precision at {target_prob:.1E}: {precision}")
+    results = {k: v/num_samples for k, v in counts.items()}
+    info = {"num_samples": num_samples, "precision": precision,
+            "converged": converged}
+    return results, intervals, info
+
+def _importance_windows(d_min, d_max, freq, h_tx, h_rx, df,
+                        rel_width=(1e-1, 1e-2, 1e-3, 1e-4, 1e-5)):
+    # Nested neighborhoods of the fading nulls of both carriers and of the
+    # minima of the two-frequency envelope (the critical distances for df).
+    # Each scale of rel_width is relative to the gap to the next null, so the
+    # deep tails are covered by the narrow windows.
+    centers = np.concatenate([crit_dist(freq, h_tx, h_rx),
+                              crit_dist(freq+df, h_tx, h_rx),
+                              crit_dist(df, h_tx, h_rx)])
+    centers = np.unique(centers[np.logical_and(centers >= d_min, centers <= d_max)])
+    if len(centers) == 0:
+        return np.empty(0), np.empty(0)
+    _gaps = np.diff(np.concatenate([[-np.inf], centers, [np.inf]]))
+    _gaps = np.minimum(_gaps[:-1], _gaps[1:])
+    _gaps[np.isinf(_gaps)] = d_max - d_min
+    half_width = np.outer(rel_width, _gaps).ravel()
+    centers = np.tile(centers, len(rel_width))
+    lower = np.maximum(centers - half_width, d_min)
+    upper = np.minimum(centers + half_width, d_max)
+    return lower, upper
+
+def _mixture_density(distance, lower, upper, weights, d_min, d_max,
+                     defensive: float):
+    # Piecewise constant density of the uniform mixture, evaluated by looking
+    # up the segment between the sorted window edges.
+    _edges = np.concatenate([lower, upper])
+    _steps = np.concatenate([weights/(upper-lower), -weights/(upper-lower)])
+    _order = np.argsort(_edges, kind='stable')
+    _edges = _edges[_order]
+    _levels = np.cumsum(_steps[_order])
+    _idx = np.searchsorted(_edges, distance, side='right') - 1
+    density = np.where(_idx >= 0, _levels[np.maximum(_idx, 0)], 0.)
+    density = (1-defensive)*np.maximum(density, 0) + defensive/(d_max-d_min)
+    return density
+
+def outage_prob_importance(d_min, d_max, freq, h_tx, h_rx, bw, df, threshold,
+                           num_samples, rel_width=(1e-1, 1e-2, 1e-3, 1e-4, 1e-5),
+                           defensive: float = .1, confidence: float = .95,
+                           noise_fig_db: float = 3, noise_den_db: float = -174,
+                           rng=None, chunk_size: int = None,
+                           dtype=np.float64):
+    # Importance sampling of the uniform distance: a defensive uniform
+    # component is mixed with uniform windows around the critical distances
+    # and each sample is reweighted by p(d)/q(d). This keeps the estimator
+    # unbiased while the weights are bounded by 1/defensive. With chunk_size,
+    # the samples are drawn chunk by chunk and only the sums of the weights
+    # (and their squares) below each threshold are kept, as in
+    # _outage_prob_streaming.
+    if rng is None:
+        rng = np.random.default_rng()
+    if chunk_size is None:
+        chunk_size = num_samples
+    lower, upper = _importance_windows(d_min, d_max, freq, h_tx, h_rx, df,
+                                       rel_width=rel_width)
+    if len(lower) == 0:
+        defensive = 1.
+    LOGGER.info(f"Importance sampling with {len(lower):d} windows around the critical distances")
+    weights = np.ones(len(lower))/max(len(lower), 1)
+
+    sums = {}
+    _buffers = [np.empty(min(chunk_size, num_samples), dtype=dtype) for _ in range(3)]
+    _num_done = 0
+    while _num_done < num_samples:
+        _num_chunk = min(chunk_size, num_samples-_num_done)
+        _num_uniform = rng.binomial(_num_chunk, defensive)
+        _num_windows = rng.multinomial(_num_chunk-_num_uniform, weights) if len(lower) else []
+        distance = np.concatenate(
+                [rng.uniform(d_min, d_max, _num_uniform)] +
+                [rng.uniform(_l, _u, _n) for _l, _u, _n in zip(lower, upper, _num_windows)])
+        density = _mixture_density(distance, lower, upper, weights, d_min,
+                                   d_max, defensive)
+        likelihood = 1./((d_max-d_min)*density)
+        rates = _generate_rates(distance, d_max, freq, h_tx, h_rx, bw, df,
+                                noise_fig_db, noise_den_db, dtype=dtype,
+                                out=[_buf[:_num_chunk] for _buf in _buffers])
+        for _name, _sums in _weighted_counts(rates, likelihood, threshold).items():
+            sums[_name] = _sums if _name not in sums else [_a + _b for _a, _b in zip(sums[_name], _sums)]
+        _num_done = _num_done + _num_chunk
+        LOGGER.debug(f"Completed {_num_done:d}/{num_samples:d} samples")
+
+    from scipy import stats
+    z = stats.norm.ppf(.5 + confidence/2)
+    results = {}
+    intervals = {}
+    for _name, (_sum_w, _sum_w2) in sums.items():
+        _prob = _sum_w/num_samples
+        _var = np.maximum(_sum_w2/num_samples - _prob**2, 0)/num_samples
+        _std = np.sqrt(_var)
+        results[_name] = _prob
+        intervals[_name] = (np.maximum(_prob - z*_std, 0), _prob + z*_std)
+    return results, intervals
+
+def _weighted_counts(rates, likelihood, threshold):
+    # Sums of the weights and of the squared weights of the samples below
+    # each threshold
+    results = {}
+    for _name, _rate in rates.items():
+        _order = np.argsort(_rate)
+        _idx = np.searchsorted(_rate[_order], threshold, side='left')
+        _sum_w = np.concatenate([[0], np.cumsum(likelihood[_order])])[_idx]
+        _sum_w2 = np.concatenate([[0], np.cumsum(likelihood[_order]**2)])[_idx]
+        results[_name] = (_sum_w, _sum_w2)
+    return results
+
+def _generate_rates(distance, d_max, freq, h_tx, h_rx, bw, df,
+                    noise_fig_db: float = 3, noise_den_db: float = -174,
+                    c=constants.c, dtype=np.float64, out=None):
+    LOGGER.debug(f"Frequency spacing: {df:E}")
+    LOGGER.debug("Work on the single and two frequency scenarios...")
+    rate_single, rate_two, rate_two_lower = rate_curves(
+            distance, freq, df, h_tx, h_rx, bw, d_max=d_max,
+            noise_fig_db=noise_fig_db, noise_den_db=noise_den_db, c=c,
+            out=out, dtype=dtype)
     rates = {"singleActual": rate_single, "twoActual": rate_two,
              "twoLower": rate_two_lower}
-    rates_hist = {k: np.histogram(v) for k, v in rates.items()}
-    rates_rv = {k: stats.rv_histogram(v) for k, v in rates_hist.items()}
+    return rates
+
+def _generate_rate_rv(distance, d_max, freq, h_tx, h_rx, bw, df,
+                      noise_fig_db: float = 3, noise_den_db: float = -174,
+                      c=constants.c, max_prob: float = None,
+                      dtype=np.float64, estimator: str = "exact"):
+    # The exact estimator keeps the sorted samples, while the histogram
+    # estimator has a fixed memory footprint and can be merged and saved.
+    LOGGER.info(f"Frequency spacing: {df:E}")
+    rates = _generate_rates(distance, d_max, freq, h_tx, h_rx, bw, df,
+                            noise_fig_db, noise_den_db, c=c, dtype=dtype)
+    if estimator == "exact":
+        rates_rv = {k: EmpiricalCDF(v, max_prob=max_prob) for k, v in rates.items()}
+    elif estimator == "histogram":
+        if max_prob is not None:
+            LOGGER.warning("The histogram estimator always covers the full distribution. Ignoring max_prob.")
+        rates_rv = {k: RateHistogram().update(v) for k, v in rates.items()}
+    else:
+        raise ValueError(f"Unknown estimator: {estimator}")
     return rates_rv
     #results = outage_prob_mc(rates, threshold)
     #return results
@@ -83,6 +626,7 @@ def _generate_rate_rv(distance, d_max, freq, h_tx, h_rx, bw, df,
 
 if __name__ == "__main__":
     import argparse
+    import matplotlib.pyplot as plt
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--h_tx", type=float, default=10.)
     parser.add_argument("-r", "--h_rx", type=float, default=1.)
@@ -90,6 +634,18 @@ if __name__ == "__main__":
     parser.add_argument("-dmin", "--d_min", type=float, default=10.)
     parser.add_argument("-dmax", "--d_max", type=float, default=100.)
     parser.add_argument("-n", "--num_samples", type=int, default=int(1e6))
+    parser.add_argument("--chunk_size", type=int, default=None)
+    parser.add_argument("--max_prob", type=float, default=None)
+    parser.add_argument("--sample_file", default=None)
+    parser.add_argument("--method", choices=["mc", "importance", "analytic", "sequential"], default="mc")
+    parser.add_argument("--target_prob", type=float, default=1e-5)
+    parser.add_argument("--rel_precision", type=float, default=.1)
+    parser.add_argument("--interval", choices=["wilson", "clopper-pearson"], default="wilson")
+    parser.add_argument("--sobol", action="store_true")
+    parser.add_argument("--estimator", choices=["exact", "histogram"], default="exact")
+    parser.add_argument("--single_precision", action="store_true")
+    parser.add_argument("-j", "--num_workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
     parser.add_argument("-bw", type=float, default=None)
     parser.add_argument("-df", type=float, default=None)
     parser.add_argument("-F", "--noise_fig_db", type=float, default=3.)
@@ -2,13 +2,13 @@ import logging
 
 import numpy as np
 from scipy import constants
-from scipy import optimize
-import matplotlib.pyplot as plt
 
-from single_frequency import rec_power, min_rec_power_single_freq, length_los, length_ref
+from single_frequency import rec_power, min_rec_power_single_freq, length_los, length_ref, crit_dist
 from two_frequencies import sum_power_lower_envelope, delta_freq_peak_approximation
 from optimal_frequency_distance import find_optimal_delta_freq
-from util import to_decibel, export_results, achievable_rate
+from util import to_decibel, export_results, achievable_rate, adaptive_grid
+from model import LinkGeometry
+import backend
 
 
 LOGGER = logging.getLogger(__name__)
@@ -61,17 +61,205 @@ def normed_alpha_power_offset(d_max, freq, delta_freq, h_tx: float, h_rx: float,
     w2 = 2*np.pi*(freq+delta_freq)
     power_offset_two = 1./(2*w1*w2)**2 * (c/4)**4 * (1/length_los(d_max, h_tx, h_rx) - 1/length_ref(d_max, h_tx, h_rx))**4
     alpha = power_offset_two/(noise_fig*noise_den*bw/2) # no square here!
-    LOGGER.debug(f"Offset power due to product: {to_decibel(alpha):.2f} dB")
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        with np.errstate(divide='ignore'):
+            LOGGER.debug(f"Offset power due to product: {np.round(to_decibel(alpha), 2)} dB")
     return alpha
+
+def rate_curves(distance, freq, delta_freq, h_tx: float, h_rx: float,
+                bw: float, d_max: float = np.infty,
+                noise_fig_db: float = 3, noise_den_db: float = -174,
+                c: float = constants.speed_of_light, out=None,
+                dtype=np.float64, block_size: int = 2**15):
+    # Fused version of rate_single_freq, rate_two_freq and rate_two_freq_lower
+    # (unit gains and transmit power). The distances are processed in blocks
+    # with in-place ufuncs, so the only full-size arrays are the three
+    # outputs, which can be passed as out=(single, two, lower). The powers use
+    # the cancellation-free forms
+    #   1/d_los^2 + 1/d_ref^2 - 2cos(phi)/(d_los d_ref)
+    #       = (d_ref-d_los)^2/(d_los d_ref)^2 + 4sin^2(phi/2)/(d_los d_ref)
+    # with d_ref-d_los = 4 h_tx h_rx/(d_los+d_ref), which also makes
+    # dtype=np.float32 usable (see check_rate_curves for its accuracy).
+    # Array-valued link parameters are broadcast against the distances, so
+    # that several configurations can be evaluated in one call.
+    distance = np.asarray(distance)
+    try:
+        _shape = np.broadcast_shapes(distance.shape, *[np.shape(_p) for _p in (
+                freq, delta_freq, h_tx, h_rx, bw, d_max)])
+    except ValueError:
+        _shape = None
+    if _shape != distance.shape:
+        raise ValueError("The link parameters need to broadcast to the shape of the distance.")
+    if out is None:
+        out = tuple(np.empty(np.shape(distance), dtype=dtype) for _ in range(3))
+    for _out in out:
+        if np.shape(_out) != np.shape(distance) or not _out.flags.c_contiguous:
+            raise ValueError("The output arrays need to be contiguous and of the same shape as the distance.")
+    _distance = np.ravel(distance)
+    _outs = [np.ravel(_out) for _out in out]
+
+    noise_fig = 10**(noise_fig_db/10.)
+    noise_den = 10**(noise_den_db/10.)
+    noise_power = noise_fig*noise_den*bw
+    omega1 = 2*np.pi*freq
+    omega2 = 2*np.pi*(freq+delta_freq)
+    # SNR per unit of the bracket in the power, with the noise of the full
+    # bandwidth. Each carrier has half of the power and half of the bandwidth
+    # in rate_two_freq, which gives the same SNR.
+    snr1 = (c/(2*omega1))**2/noise_power
+    snr2 = (c/(2*omega2))**2/noise_power
+    # Lower envelope with A=(c/2w1)^2, B=(c/2w2)^2 and r=B/A
+    _r = (omega1/omega2)**2
+    snr_lower = (c/(2*omega1))**2/noise_power
+    if np.all(np.isinf(d_max)):
+        alpha = 0.
+    else:
+        alpha = normed_alpha_power_offset(d_max, freq, delta_freq, h_tx, h_rx,
+                                          bw, noise_fig_db=noise_fig_db,
+                                          noise_den_db=noise_den_db, c=c)
+    alpha = alpha/(noise_power/2)
+
+    kernel = backend.get_kernel("rate_curves", _distance, h_tx, h_rx, freq,
+                                delta_freq, bw, alpha)
+    if kernel is not None:
+        kernel(_distance, *_outs, h_tx, h_rx, omega1, omega2, snr1, snr2, _r,
+               snr_lower, alpha, bw, c)
+        return out
+
+    # The geometry and the phases are always computed in float64. In float32,
+    # the rounding of phases of several hundred rad dominates the error close
+    # to the nulls, so the phases are reduced to [-pi, pi] before the sine is
+    # evaluated in the output dtype.
+    _reduce_phase = np.dtype(dtype) != np.float64
+    _params = {"h_diff2": (h_tx-h_rx)**2, "h_sum2": (h_tx+h_rx)**2,
+               "hh4": 4*h_tx*h_rx, "k1": omega1/(2*c), "k2": omega2/(2*c),
+               "kd": (omega2-omega1)/(2*c), "snr1": snr1, "snr2": snr2,
+               "r": _r, "snr_lower": snr_lower, "alpha": alpha,
+               "f1": bw/np.log(2), "f2": bw/(2*np.log(2))}
+    # Array-valued parameters are kept in the (small) broadcast shape of the
+    # parameters. If they only vary along the leading axes (e.g., one row of
+    # samples per configuration) and the rows hold at least 1024 samples
+    # (or one block), the blocks are aligned to the rows and use scalar
+    # parameters, which is cheaper than gathering the parameters for each
+    # sample of the block.
+    _param_shape = np.broadcast_shapes(*[np.shape(_v) for _v in _params.values()])
+    _param_shape = (1,)*(distance.ndim-len(_param_shape)) + _param_shape
+    _array_params = {k: np.ravel(np.broadcast_to(v, _param_shape))
+                     for k, v in _params.items() if np.ndim(v) > 0}
+    _row_size = 1
+    for _n, _m in zip(distance.shape[::-1], _param_shape[::-1]):
+        if _m > 1:
+            break
+        _row_size = _row_size*_n
+    _step = _row_size if _array_params and _row_size >= min(block_size, 1024) else len(_distance)
+    _blocks = [(_start, min(_start+block_size, _row+_step, len(_distance)))
+               for _row in range(0, len(_distance), max(_step, 1))
+               for _start in range(_row, min(_row+_step, len(_distance)), block_size)]
+    _buffers = [np.empty(min(block_size, len(_distance))) for _ in range(4)]
+    for _start, _stop in _blocks:
+        d = _distance[_start:_stop]
+        a, b, g, phase = [_buf[:_stop-_start] for _buf in _buffers]
+        single, two, lower = [_out[_start:_stop] for _out in _outs]
+        p = _params
+        if _array_params:
+            # Flat index of the parameters for the block (or each sample)
+            _positions = _start if _start//_row_size == (_stop-1)//_row_size else np.arange(_start, _stop)
+            _index = np.unravel_index(_positions, distance.shape)
+            _index = np.ravel_multi_index(
+                    [_i if _n > 1 else 0 for _i, _n in zip(_index, _param_shape)],
+                    _param_shape)
+            p = {**_params, **{k: v[_index] for k, v in _array_params.items()}}
+        # Geometry: a = d_ref-d_los, b = (d_ref-d_los)^2/(d_los d_ref), g = d_los d_ref
+        np.square(d, out=a); a += p["h_diff2"]; np.sqrt(a, out=a)
+        np.square(d, out=b); b += p["h_sum2"]; np.sqrt(b, out=b)
+        np.multiply(a, b, out=g)
+        a += b
+        np.divide(p["hh4"], a, out=a)
+        np.square(a, out=b); b /= g
+
+        # Single frequency and the two carriers, as log(1+snr)
+        for _out, _k, _snr in ((single, p["k1"], p["snr1"]), (two, p["k2"], p["snr2"])):
+            _phase(a, _k, phase, _out, _reduce_phase)
+            np.sin(_out, out=_out); np.square(_out, out=_out)
+            _out *= 4; _out += b; _out /= g
+            _out *= _snr
+            np.log1p(_out, out=_out)
+        two += single
+        two *= p["f2"]
+        single *= p["f1"]
+
+        # Lower envelope: (1+r) b/g + 8r u/(g ((1+r) + sqrt((1+r)^2-4ru)))
+        # with u = sin^2(dw (d_ref-d_los)/2c)
+        _r = p["r"]
+        _phase(a, p["kd"], phase, lower, _reduce_phase)
+        np.sin(lower, out=lower); np.square(lower, out=lower)
+        np.multiply(lower, -4*_r, out=a)
+        a += (1+_r)**2; np.sqrt(a, out=a); a += 1+_r
+        lower /= a
+        lower *= 8*_r
+        b *= 1+_r
+        lower += b
+        lower /= g
+        lower *= p["snr_lower"]
+        lower += p["alpha"]
+        np.log1p(lower, out=lower)
+        lower *= p["f2"]
+    return out
+
+def _phase(a, factor, phase, out, reduce_phase):
+    # out = a*factor, reduced to [-pi, pi] if out has a lower precision
+    if not reduce_phase:
+        np.multiply(a, factor, out=out)
+        return
+    np.multiply(a, factor/(2*np.pi), out=phase)
+    out[...] = phase
+    np.rint(out, out=out)
+    phase -= out
+    phase *= 2*np.pi
+    out[...] = phase
+
+def check_rate_curves(d_min: float, d_max: float, freq: float,
+                      delta_freq: float, h_tx: float, h_rx: float, bw: float,
+                      dtype=np.float32, num_points: int = 100000,
+                      noise_fig_db: float = 3, noise_den_db: float = -174,
+                      atol: float = None):
+    # Accuracy of rate_curves against the float64 rate functions, as the
+    # maximum absolute error of the spectral efficiency (bit/s/Hz) and the
+    # maximum relative error of the rate. With the optimal frequency spacing
+    # for 477 MHz to 5.8 GHz, bandwidths from 1 to 100 MHz, distances from 5 m
+    # to 1 km and heights from 1 to 30 m, the float64 kernel agrees within
+    # 1e-10 bit/s/Hz and the float32 kernel within 5e-5 bit/s/Hz (largest
+    # close to the fading nulls). An AssertionError is raised if the absolute
+    # error exceeds atol (1e-4 for float32 and 1e-9 for float64 by default).
+    if atol is None:
+        atol = 1e-9 if np.dtype(dtype) == np.float64 else 1e-4
+    distance = np.logspace(np.log10(d_min), np.log10(d_max), num_points)
+    _kwargs = dict(noise_fig_db=noise_fig_db, noise_den_db=noise_den_db)
+    geometry = LinkGeometry(distance, h_tx, h_rx)
+    reference = (rate_single_freq(geometry, freq, h_tx, h_rx, bw, **_kwargs),
+                 rate_two_freq(geometry, freq, delta_freq, h_tx, h_rx, bw, **_kwargs),
+                 rate_two_freq_lower(geometry, freq, delta_freq, h_tx, h_rx,
+                                     bw, d_max=d_max, **_kwargs))
+    fused = rate_curves(distance, freq, delta_freq, h_tx, h_rx, bw,
+                        d_max=d_max, dtype=dtype, **_kwargs)
+    errors = {}
+    for _name, _ref, _rate in zip(("single", "two", "twoLower"), reference, fused):
+        _error = np.abs(_rate.astype(float) - _ref)
+        errors[_name] = {"absolute": np.max(_error)/bw,
+                         "relative": np.max(_error/_ref)}
+        LOGGER.info(f"Error of the fused {_name} rate ({np.dtype(dtype).name}): {errors[_name]['absolute']:.2E} bit/s/Hz, {errors[_name]['relative']:.2E} (rel.)")
+    failed = [k for k, v in errors.items() if not v["absolute"] <= atol]
+    if failed:
+        raise AssertionError(f"The fused rates ({np.dtype(dtype).name}) exceed the tolerance of {atol:.1E} bit/s/Hz for: {', '.join(failed)}")
+    return errors
             
 
 def main_rate_comparison(d_min: float, d_max: float, freq: float, 
                          h_tx: float, h_rx: float, bw: float = None,
                          df: float = None, c: float = constants.speed_of_light,
                          noise_fig_db: float = 3, noise_den_db: float = -174,
-                         plot=False, export=False):
+                         tol_db: float = .25, plot=False, export=False):
 
-    distance = np.logspace(np.log10(d_min)-.1, np.log10(d_max)+.1, 3000)
     #distance = np.logspace(np.log10(d_min), np.log10(d_max), 10000)
     #distance = np.logspace(np.floor(np.log10(d_min)), np.ceil(np.log10(d_max)), 3000)
 
@@ -85,19 +273,28 @@ def main_rate_comparison(d_min: float, d_max: float, freq: float,
         bw = df/2
     LOGGER.info(f"Bandwidth (single freq band): {bw:E}")
 
+    def _rate_curves(distance):
+        geometry = LinkGeometry(distance, h_tx, h_rx)
+        rate_single = rate_single_freq(geometry, freq, h_tx, h_rx, bw=bw,
+                                       noise_fig_db=noise_fig_db,
+                                       noise_den_db=noise_den_db)
 
-    rate_single = rate_single_freq(distance, freq, h_tx, h_rx, bw=bw,
-                                   noise_fig_db=noise_fig_db,
-                                   noise_den_db=noise_den_db)
-
-    rate_two = rate_two_freq(distance, freq, df, h_tx, h_rx, bw=bw,
-                             noise_fig_db=noise_fig_db,
-                             noise_den_db=noise_den_db)
+        rate_two = rate_two_freq(geometry, freq, df, h_tx, h_rx, bw=bw,
+                                 noise_fig_db=noise_fig_db,
+                                 noise_den_db=noise_den_db)
 
-    rate_two_lower =  rate_two_freq_lower(distance, freq, df, h_tx, h_rx,
-                                          d_max=d_max, bw=bw,
-                                          noise_fig_db=noise_fig_db,
-                                          noise_den_db=noise_den_db)
+        rate_two_lower =  rate_two_freq_lower(geometry, freq, df, h_tx, h_rx,
+                                              d_max=d_max, bw=bw,
+                                              noise_fig_db=noise_fig_db,
+                                              noise_den_db=noise_den_db)
+        return np.stack([rate_single, rate_two, rate_two_lower])
+    # Nulls of both carriers and minima of the lower envelope
+    _anchors = np.concatenate([crit_dist(freq, h_tx, h_rx),
+                               crit_dist(freq+df, h_tx, h_rx),
+                               crit_dist(df, h_tx, h_rx), [d_min, d_max]])
+    distance, (rate_single, rate_two, rate_two_lower) = adaptive_grid(
+            _rate_curves, 10**(np.log10(d_min)-.1), 10**(np.log10(d_max)+.1),
+            anchors=_anchors, tol_db=tol_db)
 
     results = {"distance": distance, "rateSingle": rate_single,
                "rateTwo": rate_two, "rateTwoLower": rate_two_lower}
@@ -114,6 +311,7 @@ def main_rate_comparison(d_min: float, d_max: float, freq: float,
     #LOGGER.info(f"Minimum Rate (Two Freq.): {_min_rate_two_lower:E}")
 
     if plot:
+        import matplotlib.pyplot as plt
         fig, axs = plt.subplots()
         axs.loglog(distance, rate_single, '-b', label="Single Frequency")
         axs.loglog(distance, rate_two, '-r', label="Two Freq. - Optimal $\Delta f$")
@@ -128,6 +326,7 @@ def main_rate_comparison(d_min: float, d_max: float, freq: float,
 
 if __name__ == "__main__":
     import argparse
+    import matplotlib.pyplot as plt
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--h_tx", type=float, default=10.)
     parser.add_argument("-r", "--h_rx", type=float, default=1.)
@@ -138,6 +337,7 @@ if __name__ == "__main__":
     parser.add_argument("-df", type=float, default=None)
     parser.add_argument("-F", "--noise_fig_db", type=float, default=3.)
     parser.add_argument("-N", "--noise_den_db", type=float, default=-174)
+    parser.add_argument("--tol_db", type=float, default=.25)
     parser.add_argument("--plot", action="store_true")
     parser.add_argument("--export", action="store_true")
     parser.add_argument("-v", "--verbosity", action="count", default=0,
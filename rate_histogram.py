@@ -0,0 +1,84 @@
+import logging
+
+import numpy as np
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RateHistogram:
+    # Histogram with logarithmic bins between min_rate and max_rate and an
+    # underflow and overflow bin. The memory is fixed by num_bins and
+    # histograms with the same bins are merged by adding their counts, e.g.,
+    # across chunks or processes. Within a bin, the CDF P(X < x) is
+    # interpolated linearly in log(x), so thresholds are resolved up to the
+    # relative bin width (about 0.023% for the default 100000 bins over ten
+    # decades). Outside of [min_rate, max_rate], the CDF is only known if the
+    # underflow or overflow bin is empty and NaN otherwise.
+    def __init__(self, min_rate: float = 1., max_rate: float = 1e10,
+                 num_bins: int = 100000):
+        if not 0 < min_rate < max_rate:
+            raise ValueError("The rate range needs to satisfy 0 < min_rate < max_rate.")
+        self.edges = np.geomspace(min_rate, max_rate, num_bins+1)
+        self.counts = np.zeros(num_bins+2, dtype=np.int64)
+
+    @property
+    def num_samples(self):
+        return int(np.sum(self.counts))
+
+    def update(self, rates):
+        _idx = np.searchsorted(self.edges, np.ravel(rates), side='right')
+        self.counts += np.bincount(_idx, minlength=len(self.counts))
+        return self
+
+    def merge(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("Only histograms with the same bins can be merged.")
+        self.counts += other.counts
+        return self
+
+    def save(self, filename):
+        np.savez(filename, edges=self.edges, counts=self.counts)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as _data:
+            edges = _data["edges"]
+            histogram = cls(edges[0], edges[-1], len(edges)-1)
+            histogram.edges = edges
+            histogram.counts = _data["counts"].astype(np.int64)
+        return histogram
+
+    def cdf(self, x):
+        x = np.asarray(x, dtype=float)
+        _log_edges = np.log(self.edges)
+        # Cumulative counts at the edges, i.e., number of samples below each edge
+        _cum_edges = np.cumsum(self.counts)[:-1]
+        _bin = np.clip(np.searchsorted(self.edges, x, side='right'), 1,
+                       len(self.edges)-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _frac = (np.log(x) - _log_edges[_bin-1])/(_log_edges[_bin]-_log_edges[_bin-1])
+        _frac = np.clip(_frac, 0, 1)
+        counts = _cum_edges[_bin-1] + _frac*self.counts[_bin]
+        prob = counts/max(self.num_samples, 1)
+        prob = np.where(x < self.edges[0], 0. if self.counts[0] == 0 else np.nan, prob)
+        prob = np.where(x > self.edges[-1], 1. if self.counts[-1] == 0 else np.nan, prob)
+        return prob
+
+    def quantile(self, eps):
+        # Inverse of the interpolated CDF, i.e., the smallest rate x with
+        # P(X < x) >= eps. Quantiles within the underflow or overflow bin are NaN.
+        eps = np.asarray(eps, dtype=float)
+        _cum = np.concatenate([[0], np.cumsum(self.counts)])
+        _target = eps*self.num_samples
+        # Bin index i of the counts with _cum[i] < target <= _cum[i+1]
+        _idx = np.clip(np.searchsorted(_cum, _target, side='left') - 1, 0,
+                       len(self.counts)-1)
+        _inner = np.clip(_idx, 1, len(self.edges)-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _frac = np.where(self.counts[_inner] > 0,
+                             (_target - _cum[_inner])/self.counts[_inner], 0.)
+        _log_edges = np.log(self.edges)
+        rate = np.exp(_log_edges[_inner-1] + np.clip(_frac, 0, 1)*(_log_edges[_inner]-_log_edges[_inner-1]))
+        _outside = np.logical_or(_idx == 0, _idx == len(self.counts)-1)
+        return np.where(np.logical_and(_outside, _target > 0), np.nan, rate)
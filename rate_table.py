@@ -0,0 +1,260 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+from scipy import constants
+
+from single_frequency import crit_dist
+from optimal_frequency_distance import find_optimal_delta_freq
+from rate_comparison import rate_curves
+from util import adaptive_grid, export_results
+
+
+LOGGER = logging.getLogger(__name__)
+
+RATE_NAMES = ("singleActual", "twoActual", "twoLower")
+
+
+class RateTable:
+    # Lookup table of the rates of rate_single_freq, rate_two_freq and
+    # rate_two_freq_lower for a fixed link. Between the grid points, the rates
+    # are interpolated linearly in log(d) and log(rate). The grid is built
+    # by adaptive_grid around the nulls of both carriers and of the envelope.
+    # Afterwards, each interval is checked on num_check inner points and
+    # these points are inserted into the failing intervals, until the
+    # relative interpolation error is below rtol on all check points.
+    # Distances outside of [d_min, d_max] are evaluated directly (misses).
+    def __init__(self, d_min, d_max, freq, h_tx, h_rx, bw, df: float = None,
+                 rtol: float = 1e-3, noise_fig_db: float = 3,
+                 noise_den_db: float = -174, c: float = constants.c,
+                 num_check: int = 32):
+        _start = time.perf_counter()
+        if df is None:
+            df = find_optimal_delta_freq(d_min, d_max, freq, h_tx, h_rx, c)
+        self.d_min = d_min
+        self.d_max = d_max
+        self.params = {"freq": freq, "delta_freq": df, "h_tx": h_tx,
+                       "h_rx": h_rx, "bw": bw, "d_max": d_max,
+                       "noise_fig_db": noise_fig_db,
+                       "noise_den_db": noise_den_db, "c": c}
+        self.rtol = rtol
+        _anchors = np.concatenate([crit_dist(freq, h_tx, h_rx),
+                                   crit_dist(freq+df, h_tx, h_rx),
+                                   crit_dist(df, h_tx, h_rx)])
+        distance, rates = adaptive_grid(self._evaluate, d_min, d_max,
+                                        anchors=_anchors,
+                                        tol_db=10*np.log10(1+rtol))
+        distance, rates, self.max_error = self._verify(distance, rates,
+                                                       num_check)
+        self.distance = distance
+        self._log_distance = np.log(distance)
+        self._log_rates = np.log(rates)
+        self.build_time = time.perf_counter() - _start
+        self.num_queries = 0
+        self.hits = 0
+        self.misses = 0
+        self.query_time = 0.
+        self._lock = threading.Lock()
+        LOGGER.info(f"Built rate table with {len(distance):d} points in {self.build_time:.3f} s (max. relative error: {self.max_error:.2E})")
+
+    def _evaluate(self, distance):
+        return np.stack(rate_curves(distance, **self.params))
+
+    def _verify(self, distance, rates, num_check):
+        _steps = np.linspace(0, 1, num_check+2)[1:-1]
+        while True:
+            _log_distance = np.log(distance)
+            _check = np.exp(_log_distance[:-1, None] +
+                            np.outer(np.diff(_log_distance), _steps))
+            _values = np.reshape(self._evaluate(_check.ravel()),
+                                 (len(rates),) + _check.shape)
+            _log_rates = np.log(rates)
+            _interp = np.exp(_log_rates[:, :-1, None]*(1-_steps) +
+                             _log_rates[:, 1:, None]*_steps)
+            _error = np.max(np.abs(_interp/_values - 1), axis=(0, 2))
+            _fail = np.flatnonzero(_error > self.rtol)
+            if len(_fail) == 0:
+                return distance, rates, np.max(_error)
+            LOGGER.debug(f"Refining {len(_fail):d} intervals of the rate table")
+            _positions = np.repeat(_fail+1, num_check)
+            distance = np.insert(distance, _positions, _check[_fail].ravel())
+            rates = np.insert(rates, _positions,
+                              np.reshape(_values[:, _fail], (len(rates), -1)),
+                              axis=-1)
+
+    def query(self, distance):
+        _start = time.perf_counter()
+        distance = np.asarray(distance, dtype=float)
+        _flat = np.ravel(distance)
+        _hit = np.logical_and(_flat >= self.d_min, _flat <= self.d_max)
+        rates = np.empty((len(RATE_NAMES), len(_flat)))
+        _log_distance = np.log(_flat[_hit])
+        for _idx, _log_rates in enumerate(self._log_rates):
+            rates[_idx, _hit] = np.exp(np.interp(_log_distance,
+                                                 self._log_distance, _log_rates))
+        _num_hits = np.count_nonzero(_hit)
+        if _num_hits < len(_flat):
+            rates[:, ~_hit] = self._evaluate(_flat[~_hit])
+        with self._lock:
+            self.num_queries = self.num_queries + 1
+            self.hits = self.hits + _num_hits
+            self.misses = self.misses + len(_flat) - _num_hits
+            self.query_time = self.query_time + time.perf_counter() - _start
+        return {_name: np.reshape(_rates, distance.shape)
+                for _name, _rates in zip(RATE_NAMES, rates)}
+
+    def stats(self):
+        with self._lock:
+            return {"numPoints": len(self.distance), "rtol": self.rtol,
+                    "maxError": float(self.max_error),
+                    "buildTime": self.build_time,
+                    "numQueries": self.num_queries, "hits": self.hits,
+                    "misses": self.misses,
+                    "meanQueryTime": self.query_time/max(self.num_queries, 1)}
+
+
+def serve_rate_table(table, host: str = "127.0.0.1", port: int = 8000):
+    # Minimal HTTP server for a rate table. GET /rate?d=10,20.5 or POST /rate
+    # with the JSON body {"distance": [...]} returns the rates of all schemes,
+    # GET /stats the build time and the query statistics. For large batches,
+    # the distances can be posted as raw float64 values with the content type
+    # application/octet-stream, which returns the rates of all schemes as raw
+    # float64 values (one block of len(distance) values per scheme).
+    # Connections are kept alive and Nagle's algorithm is disabled, so that
+    # small batched queries are answered without additional round trips.
+    class _Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def _send_json(self, content, status=200):
+            _body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(_body)))
+            self.end_headers()
+            self.wfile.write(_body)
+
+        def _send_rates(self, distance):
+            try:
+                rates = table.query(np.asarray(distance, dtype=float))
+            except (TypeError, ValueError) as e:
+                self._send_json({"error": str(e)}, status=400)
+                return
+            self._send_json({k: v.tolist() for k, v in rates.items()})
+
+        def do_GET(self):
+            _url = urlparse(self.path)
+            if _url.path == "/stats":
+                self._send_json(table.stats())
+            elif _url.path == "/rate":
+                _values = parse_qs(_url.query).get("d", [""])[0]
+                self._send_rates([_d for _d in _values.split(",") if _d])
+            else:
+                self._send_json({"error": "Not found"}, status=404)
+
+        def _send_binary(self, body):
+            if len(body) % 8:
+                self._send_json({"error": "Expected float64 values"}, status=400)
+                return
+            rates = table.query(np.frombuffer(body, dtype=np.float64))
+            _body = np.stack([rates[_name] for _name in RATE_NAMES]).tobytes()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(_body)))
+            self.end_headers()
+            self.wfile.write(_body)
+
+        def do_POST(self):
+            _length = int(self.headers.get("Content-Length", 0))
+            _body = self.rfile.read(_length)
+            if urlparse(self.path).path == "/rate" and self.headers.get("Content-Type") == "application/octet-stream":
+                self._send_binary(_body)
+                return
+            try:
+                _content = json.loads(_body)
+            except ValueError as e:
+                self._send_json({"error": str(e)}, status=400)
+                return
+            if urlparse(self.path).path != "/rate":
+                self._send_json({"error": "Not found"}, status=404)
+            elif not isinstance(_content, dict) or "distance" not in _content:
+                self._send_json({"error": "Missing distance"}, status=400)
+            else:
+                self._send_rates(_content["distance"])
+
+        def log_message(self, format, *args):
+            LOGGER.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), _Handler)
+    LOGGER.info(f"Serving the rate table on http://{host}:{server.server_port}")
+    return server
+
+
+def main_rate_table(d_min, d_max, freq, h_tx, h_rx, bw, df: float = None,
+                    noise_fig_db: float = 3, noise_den_db: float = -174,
+                    rtol: float = 1e-3, host: str = "127.0.0.1",
+                    port: int = 8000, serve=False, plot=False, export=False):
+    table = RateTable(d_min, d_max, freq, h_tx, h_rx, bw, df=df, rtol=rtol,
+                      noise_fig_db=noise_fig_db, noise_den_db=noise_den_db)
+    LOGGER.info(f"Table statistics: {table.stats()}")
+    results = {"distance": table.distance,
+               **{_name: np.exp(_log_rates) for _name, _log_rates
+                  in zip(RATE_NAMES, table._log_rates)}}
+    if plot:
+        import matplotlib.pyplot as plt
+        fig, axs = plt.subplots()
+        for _name in RATE_NAMES:
+            axs.loglog(results["distance"], results[_name], '.-', label=_name)
+        axs.set_xlabel("Distance $d$ [m]")
+        axs.set_ylabel("Achievable Rate [bit/s]")
+        axs.legend()
+    if export:
+        LOGGER.info("Exporting results.")
+        export_results(results, f"rate_table-{freq:E}-dmin{d_min:.1f}-dmax{d_max:.1f}-t{h_tx:.1f}-r{h_rx:.1f}-bw{bw:E}.dat")
+    if serve:
+        server = serve_rate_table(table, host=host, port=port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            LOGGER.info(f"Stopping the server. Statistics: {table.stats()}")
+        finally:
+            server.server_close()
+    return table
+
+
+if __name__ == "__main__":
+    import argparse
+    import matplotlib.pyplot as plt
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--h_tx", type=float, default=10.)
+    parser.add_argument("-r", "--h_rx", type=float, default=1.)
+    parser.add_argument("-f", "--freq", type=float, default=2.4e9)
+    parser.add_argument("-dmin", "--d_min", type=float, default=10.)
+    parser.add_argument("-dmax", "--d_max", type=float, default=100.)
+    parser.add_argument("-bw", type=float, default=100e6)
+    parser.add_argument("-df", type=float, default=None)
+    parser.add_argument("-F", "--noise_fig_db", type=float, default=3.)
+    parser.add_argument("-N", "--noise_den_db", type=float, default=-174)
+    parser.add_argument("--rtol", type=float, default=1e-3)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--serve", action="store_true")
+    parser.add_argument("--plot", action="store_true")
+    parser.add_argument("--export", action="store_true")
+    parser.add_argument("-v", "--verbosity", action="count", default=0,
+                        help="Increase output verbosity")
+    args = vars(parser.parse_args())
+    verb = args.pop("verbosity")
+    logging.basicConfig(format="%(asctime)s - %(module)s -- [%(levelname)8s]: %(message)s",
+                        handlers=[
+                            logging.FileHandler("main.log", encoding="utf-8"),
+                            logging.StreamHandler()
+                        ])
+    loglevel = logging.WARNING - verb*10
+    LOGGER.setLevel(loglevel)
+    main_rate_table(**args)
+    plt.show()
@@ -2,12 +2,12 @@ import logging
 
 import numpy as np
 from scipy import constants
-from scipy import optimize
-import matplotlib.pyplot as plt
 
-from util import export_results, to_decibel
+from util import export_results, to_decibel, adaptive_grid
+from caching import memoize
+import backend
 
-from model import length_los, length_ref
+from model import length_los, length_ref, link_geometry
 
 
 LOGGER = logging.getLogger(__name__)
@@ -20,29 +20,38 @@ def delta_phi(distance, freq, h_tx, h_rx, c=constants.speed_of_light):
 
 def rec_power(distance, freq, h_tx, h_rx, G_los=1, G_ref=1, c=constants.c,
               power_tx=1):
-    d_los = length_los(distance, h_tx, h_rx)
-    d_ref = length_ref(distance, h_tx, h_rx)
+    geometry = link_geometry(distance, h_tx, h_rx)
+    kernel = backend.get_kernel("rec_power", geometry.d_los, freq, G_los,
+                                G_ref, c, power_tx)
+    if kernel is not None:
+        return kernel(geometry.d_los, geometry.d_ref, freq, G_los, G_ref, c,
+                      power_tx)
     omega = 2*np.pi*freq
-    phi = omega/c*(d_ref-d_los)
+    phi = omega/c*geometry.length_diff
     _factor = power_tx*(c/(2*omega))**2
-    _part1 = G_los/(d_los**2)
-    _part2 = G_ref/(d_ref**2)
-    _part3 = -2*np.sqrt(G_los*G_ref)/(d_los*d_ref) * np.cos(phi)
+    _part1 = G_los*geometry.inv_d_los**2
+    _part2 = G_ref*geometry.inv_d_ref**2
+    _part3 = -2*np.sqrt(G_los*G_ref)*geometry.inv_d_los*geometry.inv_d_ref * np.cos(phi)
     power_rx = _factor*(_part1+_part2+_part3)
     return power_rx
 
 def rec_power_lower_envelope(distance, freq, h_tx, h_rx, G_los=1, G_ref=1,
                              c=constants.c, power_tx=1):
-    d_los = length_los(distance, h_tx, h_rx)
-    d_ref = length_ref(distance, h_tx, h_rx)
+    geometry = link_geometry(distance, h_tx, h_rx)
+    kernel = backend.get_kernel("rec_power_lower_envelope", geometry.d_los,
+                                freq, G_los, G_ref, c, power_tx)
+    if kernel is not None:
+        return kernel(geometry.d_los, geometry.d_ref, freq, G_los, G_ref, c,
+                      power_tx)
     omega = 2*np.pi*freq
     _factor = power_tx*(c/(2*omega))**2
-    _part1 = G_los/(d_los**2)
-    _part2 = G_ref/(d_ref**2)
-    _part3 = -2*np.sqrt(G_los*G_ref)/(d_los*d_ref)
+    _part1 = G_los*geometry.inv_d_los**2
+    _part2 = G_ref*geometry.inv_d_ref**2
+    _part3 = -2*np.sqrt(G_los*G_ref)*geometry.inv_d_los*geometry.inv_d_ref
     power_rx = _factor*(_part1+_part2+_part3)
     return power_rx
 
+@memoize()
 def crit_dist(freq, h_tx, h_rx, c=constants.c, k=None):
     a = h_tx - h_rx
     b = h_tx + h_rx
@@ -57,6 +66,7 @@ def crit_dist(freq, h_tx, h_rx, c=constants.c, k=None):
     _d = np.real(_d)
     return _d
 
+@memoize()
 def min_rec_power_single_freq(d_min: float, d_max: float, freq,
                               h_tx, h_rx, c=constants.c):
     _crit_dist = crit_dist(freq, h_tx, h_rx)
@@ -68,11 +78,106 @@ def min_rec_power_single_freq(d_min: float, d_max: float, freq,
     return np.min([_pow_dmin, _pow_dk, _pow_dmax])
 
 
+class CritDistIndex:
+    # Critical distances of many configurations (freq, h_tx, h_rx) in a
+    # ragged (CSR) layout. The distances of the i-th configuration (in the
+    # flattened order of the broadcast parameters) are
+    # distances[offsets[i]:offsets[i+1]], sorted in ascending order, i.e.,
+    # from the largest to the smallest k in crit_dist.
+    def __init__(self, freq, h_tx, h_rx, c=constants.c):
+        freq, h_tx, h_rx = np.broadcast_arrays(
+                *[np.asarray(_x, dtype=float) for _x in (freq, h_tx, h_rx)])
+        self.shape = freq.shape
+        self.freq, self.h_tx, self.h_rx = [np.ravel(_x) for _x in (freq, h_tx, h_rx)]
+        self.c = c
+        max_phi = 2*np.pi*self.freq/c*((self.h_tx+self.h_rx)-(self.h_tx-self.h_rx))
+        counts = np.floor_divide(max_phi, 2*np.pi).astype(int)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        config = np.repeat(np.arange(len(counts)), counts)
+        k = self.offsets[config+1] - np.arange(self.offsets[-1]) + 0j
+        _freq, _h_tx, _h_rx = self.freq[config], self.h_tx[config], self.h_rx[config]
+        _d = -1/(2*c*_freq*k)*np.sqrt(c**2*k**2 - 4*_freq**2*_h_rx**2)*np.sqrt(c**2*k**2 - 4*_freq**2*_h_tx**2)
+        self.distances = np.real(_d)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def counts(self):
+        return np.reshape(np.diff(self.offsets), self.shape)
+
+    def get(self, idx):
+        return self.distances[self.offsets[idx]:self.offsets[idx+1]]
+
+    def _searchsorted(self, values, side="left"):
+        # Binary search in all segments at once
+        values = np.ravel(np.broadcast_to(values, self.shape))
+        lower = np.copy(self.offsets[:-1])
+        upper = np.copy(self.offsets[1:])
+        if len(self.distances) == 0:
+            return lower
+        while np.any(lower < upper):
+            active = lower < upper
+            middle = (lower+upper)//2
+            _dist = self.distances[np.minimum(middle, len(self.distances)-1)]
+            if side == "left":
+                right = _dist < values
+            else:
+                right = _dist <= values
+            lower = np.where(active & right, middle+1, lower)
+            upper = np.where(active & ~right, middle, upper)
+        return lower
+
+    def range_bounds(self, d_min, d_max):
+        # Indices such that distances[start:stop] are the critical distances
+        # in [d_min, d_max] of each configuration
+        start = self._searchsorted(d_min, side="left")
+        stop = self._searchsorted(d_max, side="right")
+        stop = np.maximum(start, stop)
+        return start, stop
+
+    def in_range(self, d_min, d_max):
+        # Critical distances in [d_min, d_max] as a new ragged pair
+        # (distances, offsets)
+        start, stop = self.range_bounds(d_min, d_max)
+        counts = stop - start
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        _idx = np.repeat(start - offsets[:-1], counts) + np.arange(offsets[-1])
+        return self.distances[_idx], offsets
+
+    def worst_case_power(self, d_min, d_max, **kwargs):
+        # Vectorized min_rec_power_single_freq: the minimum over d_min, d_max
+        # and the largest critical distance in between (the deepest null). If
+        # there is no critical distance in the range, the power is minimal at
+        # one of the bounds.
+        start, stop = self.range_bounds(d_min, d_max)
+        d_min = np.ravel(np.broadcast_to(d_min, self.shape)).astype(float)
+        d_max = np.ravel(np.broadcast_to(d_max, self.shape)).astype(float)
+        has_null = stop > start
+        dk_worst = np.copy(d_max)
+        dk_worst[has_null] = self.distances[stop[has_null]-1]
+        _params = dict(freq=self.freq, h_tx=self.h_tx, h_rx=self.h_rx,
+                       c=self.c, **kwargs)
+        power = np.minimum.reduce([rec_power(d_min, **_params),
+                                   rec_power(dk_worst, **_params),
+                                   rec_power(d_max, **_params)])
+        return np.reshape(power, self.shape)
+
+def min_rec_power_single_freq_batch(d_min, d_max, freq, h_tx, h_rx,
+                                    c=constants.c):
+    # Array version of min_rec_power_single_freq for sweeps over many
+    # frequencies, antenna heights, and distance ranges
+    d_min, d_max, freq, h_tx, h_rx = np.broadcast_arrays(d_min, d_max, freq,
+                                                         h_tx, h_rx)
+    index = CritDistIndex(freq, h_tx, h_rx, c=c)
+    return index.worst_case_power(d_min, d_max)
+
+
 def main_phi(freq, h_tx, h_rx, plot=False, export=False, rho=1.):
     distance = np.logspace(0, 3, 1000)
     d_phi = delta_phi(distance, freq, h_tx, h_rx)
     results = {"distance": distance, "dPhi": d_phi}
     if plot:
+        import matplotlib.pyplot as plt
         fig, axs = plt.subplots()
         axs.semilogx(distance, d_phi)
     if export:
@@ -81,21 +186,19 @@ def main_phi(freq, h_tx, h_rx, plot=False, export=False, rho=1.):
     return results
 
 
-def main_power_single_freq(freq, h_tx, h_rx, rho=1., plot=False, export=False):
+def main_power_single_freq(freq, h_tx, h_rx, rho=1., tol_db: float = .25,
+                           plot=False, export=False):
     if not 0 < rho <= 1:
         raise ValueError("Rho needs to be between 0 and 1")
     G_ref = rho**2
 
-    if freq > 1e9:
-        _num_steps = 5000
-    else:
-        _num_steps = 2000
-    distance = np.logspace(0, 3, _num_steps)
-    power_rx = rec_power(distance, freq, h_tx, h_rx, G_ref=G_ref)
-    power_rx_db = to_decibel(power_rx)
-    results = {"distance": distance, "power": power_rx_db}
     crit_distances = crit_dist(freq, h_tx, h_rx)
     LOGGER.info("Critical distances: %s", crit_distances)
+    distance, power_rx = adaptive_grid(
+            lambda d: rec_power(d, freq, h_tx, h_rx, G_ref=G_ref), 1, 1000,
+            anchors=crit_distances, tol_db=tol_db)
+    power_rx_db = to_decibel(power_rx)
+    results = {"distance": distance, "power": power_rx_db}
 
     dmin = 30
     dmax = 100
@@ -111,6 +214,7 @@ def main_power_single_freq(freq, h_tx, h_rx, rho=1., plot=False, export=False):
     LOGGER.info(f"Power at max d_k = {_pr_d1:.1f}")
 
     if plot:
+        import matplotlib.pyplot as plt
         fig, axs = plt.subplots()
         axs.semilogx(distance, power_rx_db)
         axs.vlines(crit_distances, min(power_rx_db), max(power_rx_db),
@@ -124,17 +228,20 @@ def main_power_single_freq(freq, h_tx, h_rx, rho=1., plot=False, export=False):
 
 if __name__ == "__main__":
     import argparse
+    import matplotlib.pyplot as plt
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--h_tx", type=float, default=10.)
     parser.add_argument("-r", "--h_rx", type=float, default=1.)
     parser.add_argument("-f", "--freq", type=float, default=2.4e9)
     parser.add_argument("--rho", type=float, default=1.)
+    parser.add_argument("--tol_db", type=float, default=.25)
     parser.add_argument("--plot", action="store_true")
     parser.add_argument("--export", action="store_true")
     parser.add_argument("-v", "--verbosity", action="count", default=0,
                         help="Increase output verbosity")
     args = vars(parser.parse_args())
     verb = args.pop("verbosity")
+    tol_db = args.pop("tol_db")
     logging.basicConfig(format="%(asctime)s - %(module)s -- [%(levelname)8s]: %(message)s",
                         handlers=[
                             logging.FileHandler("main.log", encoding="utf-8"),
@@ -143,5 +250,5 @@ if __name__ == "__main__":
     loglevel = logging.WARNING - verb*10
     LOGGER.setLevel(loglevel)
     main_phi(**args)
-    main_power_single_freq(**args)
+    main_power_single_freq(**args, tol_db=tol_db)
     plt.show()
@@ -2,13 +2,12 @@ import logging
 
 import numpy as np
 from scipy import constants
-from scipy import optimize
-import matplotlib.pyplot as plt
 
-from util import export_results, to_decibel
+from util import export_results, to_decibel, minimize_scalar_vectorized
+import backend
 
-from model import length_los, length_ref
-from single_frequency import rec_power, crit_dist
+from model import length_los, length_ref, link_geometry, LinkGeometry
+from single_frequency import rec_power, crit_dist, CritDistIndex
 
 #plt.rc('text', usetex=True)
 
@@ -18,20 +17,42 @@ LOGGER = logging.getLogger(__name__)
 def sum_power_lower_envelope(distance, delta_freq, freq, 
                              h_tx, h_rx, G_los=1, G_ref=1,
                              c=constants.c, power_tx=1):
-    d_los = length_los(distance, h_tx, h_rx)
-    d_ref = length_ref(distance, h_tx, h_rx)
+    geometry = link_geometry(distance, h_tx, h_rx)
+    kernel = backend.get_kernel("sum_power_lower_envelope", geometry.d_los,
+                                delta_freq, freq, c, power_tx)
+    if kernel is not None:
+        return kernel(geometry.d_los, geometry.d_ref, delta_freq, freq, c,
+                      power_tx)
     freq2 = freq+delta_freq
     omega = 2*np.pi*freq
     omega2 = 2*np.pi*freq2
     delta_omega = omega2-omega
-    _part1 = c**2/(4*d_los**2) * (1./omega**2 + 1./omega2**2)
-    _part2 = c**2/(4*d_ref**2) * (1./omega**2 + 1./omega2**2)
+    _part1 = c**2/4*geometry.inv_d_los**2 * (1./omega**2 + 1./omega2**2)
+    _part2 = c**2/4*geometry.inv_d_ref**2 * (1./omega**2 + 1./omega2**2)
     A = (c/(2*omega))**2
     B = (c/(2*omega2))**2
-    _part3 = -2/(d_los*d_ref) * np.sqrt(A**2 + B**2 + 2*A*B*np.cos(delta_omega/c*(d_ref-d_los)))
+    _part3 = -2*geometry.inv_d_los*geometry.inv_d_ref * np.sqrt(A**2 + B**2 + 2*A*B*np.cos(delta_omega/c*geometry.length_diff))
     power_rx = power_tx/2 * (_part1 + _part2 + _part3)
     return power_rx
 
+def sum_power_lower_envelope_ddf(distance, delta_freq, freq, h_tx, h_rx,
+                                 c=constants.c, power_tx=1):
+    # Derivative of sum_power_lower_envelope with respect to delta_freq
+    geometry = link_geometry(distance, h_tx, h_rx)
+    freq2 = freq+delta_freq
+    omega = 2*np.pi*freq
+    omega2 = 2*np.pi*freq2
+    A = (c/(2*omega))**2
+    B = (c/(2*omega2))**2
+    dB = -2*B/freq2
+    _phase = (omega2-omega)/c*geometry.length_diff
+    _root = np.sqrt(A**2 + B**2 + 2*A*B*np.cos(_phase))
+    _droot = (dB*(B + A*np.cos(_phase))
+              - A*B*np.sin(_phase)*2*np.pi*geometry.length_diff/c)/_root
+    _inv_sq = geometry.inv_d_los**2 + geometry.inv_d_ref**2
+    return power_tx/2 * (dB*_inv_sq
+                         - 2*geometry.inv_d_los*geometry.inv_d_ref*_droot)
+
 def delta_freq_for_dist(d, h_tx=10, h_rx=2, c=constants.speed_of_light):
     _factor = c*np.pi/(np.sqrt(2)*h_rx*h_tx)
     _part_inner = np.sqrt((d**2+h_rx**2)**2 + 2*(d-h_rx)*(d+h_rx)*h_tx**2 + h_tx**4)
@@ -46,24 +67,155 @@ def delta_freq_peak_approximation(distance, h_tx, h_rx, c=constants.c):
     a = (d_ref-d_los)/c
     return np.array([1, 2])/(2*a)
 
+def sum_power(distance, delta_freq, freq, h_tx, h_rx, c=constants.c):
+    # Exact receive power when the transmit power is split between f and f+df
+    geometry = link_geometry(distance, h_tx, h_rx)
+    return .5*(rec_power(geometry, freq, h_tx, h_rx, c=c) +
+               rec_power(geometry, freq+delta_freq, h_tx, h_rx, c=c))
+
+def _sum_power_bound(lower, upper, delta_freq, freq, h_tx, h_rx,
+                     c=constants.c):
+    # Lower bound of sum_power on [lower, upper]. With u = d_ref-d_los and
+    # p = d_los d_ref, the sum power is
+    #   (u/p)^2 (K1+K2) + 4/p T(u),  T(u) = K1 sin^2(a1 u) + K2 sin^2(a2 u),
+    # with K = (c/2w)^2/2 and a = w/2c. Since u/p and 1/p decrease with the
+    # distance, they are bounded by their values at the upper end. T is
+    # bounded over the range of u by the larger of the minima of each sin^2
+    # over its phase range and the second order expansion around the center
+    # with |T''| <= 2(K1 a1^2 + K2 a2^2).
+    _d_los = length_los(upper, h_tx, h_rx)
+    _d_ref = length_ref(upper, h_tx, h_rx)
+    _prod = _d_los*_d_ref
+    u_upper = 4*h_tx*h_rx/(_d_los+_d_ref)
+    u_lower = 4*h_tx*h_rx/(length_los(lower, h_tx, h_rx)+length_ref(lower, h_tx, h_rx))
+    _half_width = .5*(u_lower-u_upper)
+    _u_mid = .5*(u_lower+u_upper)
+    K_sum = 0.
+    bound_phase = 0.
+    T_mid = 0.
+    dT_mid = 0.
+    curvature = 0.
+    for _freq in (freq, freq+delta_freq):
+        omega = 2*np.pi*_freq
+        K = .5*(c/(2*omega))**2
+        a = omega/(2*c)
+        _theta_lower = a*u_upper
+        _theta_upper = a*u_lower
+        _has_null = np.floor(_theta_upper/np.pi) >= np.ceil(_theta_lower/np.pi)
+        _sin2 = np.where(_has_null, 0., np.minimum(np.sin(_theta_lower)**2,
+                                                   np.sin(_theta_upper)**2))
+        bound_phase = bound_phase + K*_sin2
+        T_mid = T_mid + K*np.sin(a*_u_mid)**2
+        dT_mid = dT_mid + K*a*np.sin(2*a*_u_mid)
+        curvature = curvature + 2*K*a**2
+        K_sum = K_sum + K
+    bound_taylor = T_mid - np.abs(dT_mid)*_half_width - .5*curvature*_half_width**2
+    T_min = np.maximum(bound_phase, bound_taylor)
+    return K_sum*(u_upper/_prod)**2 + 4*T_min/_prod
+
+def min_sum_power(d_min, d_max, delta_freq, freq, h_tx, h_rx, c=constants.c,
+                  rtol: float = 1e-4, xtol: float = 1e-8, max_iter: int = 100,
+                  full_output: bool = False):
+    # Global minimum of the exact sum power over [d_min, d_max] for arrays of
+    # configurations (e.g., many candidates of df). The interval is split at
+    # the nulls of both carriers and a branch-and-bound with _sum_power_bound
+    # bisects these brackets until no part of the interval can be smaller
+    # than the best evaluated point by more than rtol (relative). The best
+    # point is finally refined by a golden section search in its bracket.
+    # With full_output, the minimizing distance, the certified lower bound
+    # and the number of iterations are returned as well.
+    d_min, d_max, delta_freq, freq, h_tx, h_rx = np.broadcast_arrays(
+            *[np.asarray(_x, dtype=float) for _x in (d_min, d_max, delta_freq, freq, h_tx, h_rx)])
+    if np.any(d_max <= d_min):
+        raise ValueError("The maximum distance needs to be larger than the minimum distance.")
+    shape = d_min.shape
+    d_min, d_max, delta_freq, freq, h_tx, h_rx = [
+            np.ravel(_x) for _x in (d_min, d_max, delta_freq, freq, h_tx, h_rx)]
+    _num = len(d_min)
+    _params = lambda idx: (delta_freq[idx], freq[idx], h_tx[idx], h_rx[idx], c)
+
+    # Brackets between the nulls of both carriers and the interval bounds
+    index = CritDistIndex(np.concatenate([freq, freq+delta_freq]),
+                          np.tile(h_tx, 2), np.tile(h_rx, 2), c=c)
+    nulls, offsets = index.in_range(np.tile(d_min, 2), np.tile(d_max, 2))
+    _config = np.concatenate([np.repeat(np.tile(np.arange(_num), 2), np.diff(offsets)),
+                              np.arange(_num), np.arange(_num)])
+    _edges = np.concatenate([nulls, d_min, d_max])
+    _order = np.lexsort((_edges, _config))
+    _config, _edges = _config[_order], _edges[_order]
+    _same = _config[1:] == _config[:-1]
+    lower, upper, config = _edges[:-1][_same], _edges[1:][_same], _config[:-1][_same]
+
+    _func = lambda d, idx: sum_power(d, *_params(idx))
+    power_min = np.full(_num, np.inf)
+    distance = np.copy(d_min)
+    half_width = np.zeros(_num)
+    def _update(x, f, idx, width):
+        np.minimum.at(power_min, idx, f)
+        _best = f == power_min[idx]
+        distance[idx[_best]] = x[_best]
+        half_width[idx[_best]] = .5*width[_best]
+    _update(_edges, _func(_edges, _config), _config, np.zeros(len(_edges)))
+
+    # Branch and bound
+    lower_bound = np.full(_num, np.inf)
+    for _iter in range(max_iter):
+        _bound = _sum_power_bound(lower, upper, *_params(config))
+        _active = _bound < power_min[config]*(1-rtol)
+        np.minimum.at(lower_bound, config[~_active], _bound[~_active])
+        lower, upper, config = lower[_active], upper[_active], config[_active]
+        _bound = _bound[_active]
+        _split = upper-lower > xtol*upper
+        np.minimum.at(lower_bound, config[~_split], _bound[~_split])
+        lower, upper, config = lower[_split], upper[_split], config[_split]
+        if len(config) == 0:
+            break
+        _mid = .5*(lower+upper)
+        _update(_mid, _func(_mid, config), config, upper-lower)
+        lower, upper = np.concatenate([lower, _mid]), np.concatenate([_mid, upper])
+        config = np.tile(config, 2)
+    else:
+        LOGGER.warning(f"Branch and bound did not converge for {len(np.unique(config)):d} configurations after {max_iter:d} iterations")
+        np.minimum.at(lower_bound, config, _sum_power_bound(lower, upper, *_params(config)))
+    lower_bound = np.minimum(lower_bound, power_min)
+
+    # Local refinement around the best point
+    _all = np.arange(_num)
+    x_opt, f_opt = minimize_scalar_vectorized(
+            lambda d: _func(d, _all), np.maximum(distance-half_width, d_min),
+            np.minimum(distance+half_width, d_max), xtol=xtol)
+    _better = f_opt < power_min
+    distance[_better] = x_opt[_better]
+    power_min[_better] = f_opt[_better]
+
+    power_min = np.reshape(power_min, shape)
+    if full_output:
+        info = {"distance": np.reshape(distance, shape),
+                "lower_bound": np.reshape(lower_bound, shape),
+                "iterations": _iter+1}
+        return power_min, info
+    return power_min
+
 
 def main_power_two_freq(freq, delta_freq, h_tx, h_rx,
                         plot=False, export=False, **kwargs):
     distance = np.logspace(0, 3, 2000)
-    power_rx = rec_power(distance, freq, h_tx, h_rx)
+    geometry = LinkGeometry(distance, h_tx, h_rx)
+    power_rx = rec_power(geometry, freq, h_tx, h_rx)
     power_rx_db = to_decibel(power_rx)
     freq2 = freq + delta_freq
-    power_rx2 = rec_power(distance, freq2, h_tx, h_rx)
+    power_rx2 = rec_power(geometry, freq2, h_tx, h_rx)
     power_rx2_db = to_decibel(power_rx2)
     power_sum = .5*(power_rx+power_rx2)
     power_sum_db = to_decibel(power_sum)
-    power_sum_lower = sum_power_lower_envelope(distance, delta_freq, freq, h_tx, h_rx)
+    power_sum_lower = sum_power_lower_envelope(geometry, delta_freq, freq, h_tx, h_rx)
     power_sum_lower_db = to_decibel(power_sum_lower)
     results = {"distance": distance,
                "powerSum": power_sum_db,
                "envelope": power_sum_lower_db}
 
     if plot:
+        import matplotlib.pyplot as plt
         fig, axs = plt.subplots()
         axs.semilogx(distance, power_sum_db)
         axs.semilogx(distance, power_sum_lower_db)
@@ -100,6 +252,7 @@ def main_optimization_problem(d_min, d_max, freq, h_tx, h_rx, c=constants.c,
     results2 = {"df": df2, "dw": 2*np.pi*df2, "pmax": p_max2_db, "pd1": p_d1_db}
 
     if plot:
+        import matplotlib.pyplot as plt
         fig, axs = plt.subplots()
         axs.semilogx(df1, p_min_db, 'b-', label="${P_r}(d_{min})$")
         axs.semilogx(df1, p_max1_db, 'r-', label="${P_r}(d_{max})$")
@@ -116,6 +269,7 @@ def main_optimization_problem(d_min, d_max, freq, h_tx, h_rx, c=constants.c,
 
 if __name__ == "__main__":
     import argparse
+    import matplotlib.pyplot as plt
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--h_tx", type=float, default=10.)
     parser.add_argument("-r", "--h_rx", type=float, default=1.)
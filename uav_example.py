@@ -1,8 +1,9 @@
 import logging
+import os
+import json
+import hashlib
 
 import numpy as np
-import matplotlib.pyplot as plt
-import sdeint
 
 from optimal_frequency_distance import find_optimal_delta_freq
 from outage_probability import _generate_rate_rv
@@ -12,7 +13,10 @@ LOGGER = logging.getLogger(__name__)
 
 def main(freq, h_tx, h_rx, bw, df: float = None, radius=150, d_lake=30,
          noise_fig_db: float = 3, noise_den_db: float = -174,
-         num_runs=1000, num_steps=2000, plot=False, export=False):
+         num_runs=1000, num_steps=2000, max_prob: float = None,
+         max_attempts: int = None, max_batch: int = 2000, seed: int = None,
+         store_dir: str = None, store_positions: bool = False,
+         estimator: str = "exact", plot=False, export=False):
     pos_tx = (radius+d_lake)*np.exp(1j*np.pi/4)
     d_min = d_lake
     d_max = d_lake + 2*radius
@@ -24,28 +28,25 @@ def main(freq, h_tx, h_rx, bw, df: float = None, radius=150, d_lake=30,
     a = np.array([[0, -1, 0], [3, 1, 3], [0, 0, 7]])
     b = np.array([[0, 0, 0], [0, 1, 0], [0, 0, 1]])
     timeline = np.linspace(0, 100, num_steps)
-    distance = np.array([])
-    _count = 0
-    while len(distance) < num_runs*num_steps:
-        positions = get_uav_positions(a, b, timeline)
-        _positions = positions["x"] + 1j*positions["y"]
-        if np.any(np.abs(_positions) > radius):
-            continue
-        _distances = np.abs(_positions - pos_tx)
-        distance = np.append(distance, _distances)
-        _count = _count + 1
-        LOGGER.debug(f"Completed run {_count:d}/{num_runs:d}")
+    distance, positions = get_uav_distances(a, b, timeline, num_runs, radius,
+                                            d_lake, seed=seed,
+                                            store_dir=store_dir,
+                                            store_positions=store_positions,
+                                            max_attempts=max_attempts,
+                                            max_batch=max_batch)
     LOGGER.info(f"Completed all {num_runs:d} runs with {num_steps:d} time samples each.")
 
     LOGGER.debug("Estimate outage probabilities... (This might take a while...)")
     rate_rv = _generate_rate_rv(distance, d_max, freq, h_tx, h_rx, bw, df,
-                                noise_fig_db, noise_den_db)
+                                noise_fig_db, noise_den_db, max_prob=max_prob,
+                                estimator=estimator)
     #threshold = np.logspace(3, 9, 2000)
     threshold = np.logspace(1, 7, 2000)
     results = {k: v.cdf(threshold) for k, v in rate_rv.items()}
 
 
     if plot:
+        import matplotlib.pyplot as plt
         fig, axs = plt.subplots()
         for i in range(len(timeline)-1):
             axs.plot(positions['x'][i:i+2], positions['y'][i:i+2],
@@ -66,21 +67,170 @@ def main(freq, h_tx, h_rx, bw, df: float = None, radius=150, d_lake=30,
         export_results(results, f"out_prob_uav-{freq:E}-dmin{d_min:.1f}-dmax{d_max:.1f}-t{h_tx:.1f}-r{h_rx:.1f}-bw{bw:E}-df{df:E}.dat")
     return results
 
-def get_uav_positions(a, b, timeline):
-    def f(x, t):
-        return -a.dot(x)
-    def G(x, t):
-        return b
-    x0 = np.array([0, 0, 0])
-    x = sdeint.itoint(f, G, x0, timeline)
-    y = sdeint.itoint(f, G, x0, timeline)
-    scale = 100
-    positions = {"x": scale*x[:, 0], "y": scale*y[:, 0],
+def get_uav_distances(a, b, timeline, num_runs, radius, d_lake,
+                      seed: int = None, store_dir: str = None,
+                      store_positions: bool = False,
+                      max_attempts: int = None, max_batch: int = 2000):
+    # Distances only depend on the geometry, the SDE, the seed and the batch
+    # sizes (max_batch and max_attempts), since the batches draw from the same
+    # random stream. With a seed and a store directory, they are saved under a
+    # hash of these parameters and reused as np.memmap by later runs.
+    pos_tx = (radius+d_lake)*np.exp(1j*np.pi/4)
+    num_steps = len(timeline)
+    rng = np.random.default_rng(seed)
+    if store_dir is None or seed is None:
+        if store_dir is not None:
+            LOGGER.warning("The trajectory store is only used with a fixed seed.")
+        distance = np.empty(num_runs*num_steps)
+        return sample_uav_distances(a, b, timeline, num_runs, radius, pos_tx,
+                                    out=distance, max_attempts=max_attempts,
+                                    max_batch=max_batch, rng=rng)
+
+    if max_attempts is None:
+        max_attempts = 100*num_runs
+    _key = _uav_store_key(a, b, timeline, num_runs, radius, d_lake, seed,
+                          max_attempts, max_batch)
+    _file_distance = os.path.join(store_dir, f"uav_distance-{_key}.npy")
+    _file_positions = os.path.join(store_dir, f"uav_positions-{_key}.npy")
+    _file_example = os.path.join(store_dir, f"uav_example-{_key}.npz")
+    if os.path.isfile(_file_distance) and os.path.isfile(_file_example):
+        LOGGER.info(f"Loading stored trajectories: {_file_distance}")
+        distance = np.load(_file_distance, mmap_mode='r')
+        positions = dict(np.load(_file_example))
+        return distance, positions
+
+    LOGGER.info(f"Generating trajectories for the store: {_file_distance}")
+    os.makedirs(store_dir, exist_ok=True)
+    _tmp_distance = f"{_file_distance}.tmp.npy"
+    distance = np.lib.format.open_memmap(_tmp_distance, mode='w+',
+                                         dtype=float, shape=(num_runs*num_steps,))
+    all_positions = None
+    if store_positions:
+        _tmp_positions = f"{_file_positions}.tmp.npy"
+        all_positions = np.lib.format.open_memmap(_tmp_positions, mode='w+',
+                                                  dtype=complex,
+                                                  shape=(num_runs, num_steps))
+    distance, positions = sample_uav_distances(a, b, timeline, num_runs,
+                                               radius, pos_tx, out=distance,
+                                               out_positions=all_positions,
+                                               max_attempts=max_attempts,
+                                               max_batch=max_batch, rng=rng)
+    distance.flush()
+    del distance
+    os.replace(_tmp_distance, _file_distance)
+    if store_positions:
+        all_positions.flush()
+        del all_positions
+        os.replace(_tmp_positions, _file_positions)
+    np.savez(_file_example, **positions)
+    distance = np.load(_file_distance, mmap_mode='r')
+    return distance, positions
+
+def _uav_store_key(a, b, timeline, num_runs, radius, d_lake, seed,
+                   max_attempts, max_batch):
+    _params = {"version": 2, "a": np.asarray(a).tolist(),
+               "b": np.asarray(b).tolist(),
+               "timeline": hashlib.sha256(np.asarray(timeline, dtype=float).tobytes()).hexdigest(),
+               "num_runs": int(num_runs), "radius": float(radius),
+               "d_lake": float(d_lake), "seed": int(seed),
+               "max_attempts": int(max_attempts), "max_batch": int(max_batch)}
+    _hash = hashlib.sha256(json.dumps(_params, sort_keys=True).encode())
+    return _hash.hexdigest()[:16]
+
+def sample_uav_distances(a, b, timeline, num_runs, radius, pos_tx, out=None,
+                         out_positions=None, max_attempts: int = None,
+                         max_batch: int = 2000, rng=None):
+    # Trajectories that leave the circle are rejected. The accepted distances
+    # are written in place into out (e.g., a preallocated array or a
+    # np.memmap), the complex positions optionally into out_positions, and
+    # each batch is sized from the acceptance rate observed
+    # so far.
+    num_steps = len(timeline)
+    if out is None:
+        out = np.empty(num_runs*num_steps)
+    if max_attempts is None:
+        max_attempts = 100*num_runs
+    if rng is None:
+        rng = np.random.default_rng()
+    _accepted = 0
+    _generated = 0
+    positions = None
+    while _accepted < num_runs:
+        _remaining = num_runs - _accepted
+        if _generated >= max_attempts:
+            raise RuntimeError(f"Only {_accepted:d}/{num_runs:d} trajectories stayed within the radius after {_generated:d} attempts.")
+        # Without any accepted run so far, the batch grows geometrically
+        _acceptance = max(_accepted, 1)/_generated if _generated > 0 else 1.
+        _num_batch = int(np.ceil(1.1*_remaining/_acceptance))
+        _num_batch = max(1, min(_num_batch, max_batch, max_attempts-_generated))
+        trajectories = generate_uav_trajectories(a, b, timeline, _num_batch, rng=rng)
+        _positions = trajectories["x"] + 1j*trajectories["y"]
+        _idx_valid = np.flatnonzero(np.all(np.abs(_positions) <= radius, axis=1))
+        _idx_valid = _idx_valid[:_remaining]
+        _generated = _generated + _num_batch
+        if len(_idx_valid) > 0:
+            _distances = np.abs(_positions[_idx_valid] - pos_tx)
+            out[_accepted*num_steps:(_accepted+len(_idx_valid))*num_steps] = np.ravel(_distances)
+            if out_positions is not None:
+                out_positions[_accepted:_accepted+len(_idx_valid)] = _positions[_idx_valid]
+            _accepted = _accepted + len(_idx_valid)
+            positions = {"x": trajectories["x"][_idx_valid[-1]],
+                         "y": trajectories["y"][_idx_valid[-1]],
+                         "c": trajectories["c"]}
+        LOGGER.debug(f"Completed run {_accepted:d}/{num_runs:d}")
+    LOGGER.info(f"Acceptance rate of the trajectories: {_accepted/_generated:.3f} ({_accepted:d}/{_generated:d})")
+    return out, positions
+
+def get_uav_positions(a, b, timeline, rng=None):
+    positions = generate_uav_trajectories(a, b, timeline, num_runs=1, rng=rng)
+    positions = {"x": positions["x"][0], "y": positions["y"][0],
+                 "c": positions["c"]}
+    return positions
+
+def generate_uav_trajectories(a, b, timeline, num_runs, rng=None, scale=100):
+    # The SDE dx = -a x dt + b dW is linear, so it is sampled exactly with
+    # x[k+1] = expm(-a dt) x[k] + w[k] and Gaussian w[k] with covariance
+    # int_0^dt expm(-a s) b b^T expm(-a^T s) ds. Both axes of all runs are
+    # propagated at once.
+    if rng is None:
+        rng = np.random.default_rng()
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    _dt = np.round(np.diff(timeline), 12)
+    _transitions = {_step: _exact_discretization(a, b, _step)
+                    for _step in np.unique(_dt)}
+    x = np.zeros((2*num_runs, len(a)))
+    trajectories = np.zeros((len(timeline), 2*num_runs))
+    for _idx, _step in enumerate(_dt):
+        _phi, _noise_factor = _transitions[_step]
+        _noise = rng.standard_normal(x.shape)
+        x = x @ _phi.T + _noise @ _noise_factor.T
+        trajectories[_idx+1] = x[:, 0]
+    trajectories = np.reshape(trajectories.T, (num_runs, 2, len(timeline)))
+    positions = {"x": scale*trajectories[:, 0],
+                 "y": scale*trajectories[:, 1],
                  "c": timeline/max(timeline)}
     return positions
 
+def _exact_discretization(a, b, dt):
+    # Van Loan's method for the transition matrix and the noise covariance
+    from scipy import linalg
+    _dim = len(a)
+    _block = np.zeros((2*_dim, 2*_dim))
+    _block[:_dim, :_dim] = a
+    _block[:_dim, _dim:] = b @ b.T
+    _block[_dim:, _dim:] = -a.T
+    _exp_block = linalg.expm(_block*dt)
+    phi = _exp_block[_dim:, _dim:].T
+    cov = phi @ _exp_block[:_dim, _dim:]
+    cov = .5*(cov + cov.T)
+    _eig_val, _eig_vec = np.linalg.eigh(cov)
+    noise_factor = _eig_vec*np.sqrt(np.maximum(_eig_val, 0))
+    return phi, noise_factor
+
 if __name__ == "__main__":
     import argparse
+    import matplotlib.pyplot as plt
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--h_tx", type=float, default=10.)
     parser.add_argument("-r", "--h_rx", type=float, default=1.)
@@ -89,6 +239,13 @@ if __name__ == "__main__":
     parser.add_argument("-l", "--d_lake", type=float, default=30.)
     parser.add_argument("-n", "--num_runs", type=int, default=int(1e3))
     parser.add_argument("-bw", type=float, default=100e6)
+    parser.add_argument("--max_prob", type=float, default=None)
+    parser.add_argument("--max_attempts", type=int, default=None)
+    parser.add_argument("--max_batch", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--store_dir", default=None)
+    parser.add_argument("--store_positions", action="store_true")
+    parser.add_argument("--estimator", choices=["exact", "histogram"], default="exact")
     parser.add_argument("-df", type=float, default=None)
     parser.add_argument("-F", "--noise_fig_db", type=float, default=3.)
     parser.add_argument("-N", "--noise_den_db", type=float, default=-174)
@@ -1,16 +1,269 @@
+import os
+import json
+import logging
+
 import numpy as np
-import pandas as pd
+
+import backend
+
+
+LOGGER = logging.getLogger(__name__)
+
+# Export formats selected by the file extension. The "columns" format is a
+# directory with one raw binary file per column and a JSON header.
+EXPORT_FORMATS = {".npz": "npz", ".cols": "columns"}
 
 def to_decibel(value):
     return 10*np.log10(value)
 
-def export_results(results, filename):
-    df = pd.DataFrame.from_dict(results)
-    df.to_csv(filename, sep='\t', index=False)
+def export_results(results, filename, fmt: str = None):
+    fmt = _export_format(filename, fmt)
+    if fmt == "text":
+        import pandas as pd
+        df = pd.DataFrame.from_dict(results)
+        df.to_csv(filename, sep='\t', index=False)
+    elif fmt == "npz":
+        np.savez(filename, **{k: np.asarray(v) for k, v in results.items()})
+    else:
+        with ResultsWriter(filename, fmt=fmt) as writer:
+            writer.append(results)
+
+def _export_format(filename, fmt=None):
+    if fmt is None:
+        fmt = EXPORT_FORMATS.get(os.path.splitext(filename)[1], "text")
+    if fmt not in ("text", "npz", "columns"):
+        raise ValueError(f"Unknown export format: {fmt}")
+    return fmt
+
+class ResultsWriter:
+    # Streaming writer (truncates on open), so that chunked computations can
+    # flush their results without holding the full table in memory. Supports
+    # the text and the binary columns format. The dtypes of the first chunk
+    # are kept for all later chunks in both formats.
+    def __init__(self, filename, fmt: str = None):
+        self.filename = filename
+        self.fmt = _export_format(filename, fmt)
+        if self.fmt == "npz":
+            raise ValueError("The npz format does not support appending. Use the columns format instead.")
+        self.columns = None
+        self._files = {}
+        self._lengths = {}
+
+    def append(self, results):
+        if self.columns is None:
+            self._open(list(results))
+        elif list(results) != self.columns:
+            raise ValueError(f"Columns {list(results)} do not match {self.columns}")
+        if self.fmt == "text":
+            import pandas as pd
+            df = pd.DataFrame.from_dict(results)
+            for _name in self.columns:
+                if _name not in self._dtypes:
+                    self._dtypes[_name] = df[_name].dtype
+            df = df.astype(self._dtypes, copy=False)
+            df.to_csv(self._files["text"], sep='\t', index=False,
+                      header=self._lengths["text"] == 0)
+            self._lengths["text"] = self._lengths["text"] + len(df)
+        else:
+            for _name, _values in results.items():
+                _values = np.ascontiguousarray(np.atleast_1d(_values))
+                if _name not in self._dtypes:
+                    self._dtypes[_name] = _values.dtype
+                _values.astype(self._dtypes[_name], copy=False).tofile(self._files[_name])
+                self._lengths[_name] = self._lengths[_name] + len(_values)
+            self._write_header()
+
+    def _open(self, columns):
+        self.columns = columns
+        self._dtypes = {}
+        if self.fmt == "text":
+            self._files["text"] = open(self.filename, 'w', newline='')
+            self._lengths["text"] = 0
+        else:
+            os.makedirs(self.filename, exist_ok=True)
+            for _idx, _name in enumerate(columns):
+                self._files[_name] = open(os.path.join(self.filename, f"{_idx:d}.bin"), 'wb')
+                self._lengths[_name] = 0
+
+    def _write_header(self):
+        header = {"format": "columns", "version": 1,
+                  "columns": [{"name": _name, "file": f"{_idx:d}.bin",
+                               "dtype": self._dtypes[_name].str,
+                               "length": self._lengths[_name]}
+                              for _idx, _name in enumerate(self.columns)]}
+        with open(os.path.join(self.filename, "header.json"), 'w') as _header_file:
+            json.dump(header, _header_file, indent=2)
+
+    def close(self):
+        for _file in self._files.values():
+            _file.close()
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def load_results(filename, fmt: str = None, mmap: bool = True):
+    fmt = _export_format(filename, fmt)
+    if fmt == "text":
+        import pandas as pd
+        df = pd.read_csv(filename, sep='\t')
+        return {k: df[k].to_numpy() for k in df.columns}
+    elif fmt == "npz":
+        with np.load(filename) as _data:
+            return dict(_data)
+    with open(os.path.join(filename, "header.json")) as _header_file:
+        header = json.load(_header_file)
+    results = {}
+    for _column in header["columns"]:
+        _path = os.path.join(filename, _column["file"])
+        if mmap and _column["length"] > 0:
+            results[_column["name"]] = np.memmap(_path, dtype=_column["dtype"], mode='r',
+                                                 shape=(_column["length"],))
+        else:
+            results[_column["name"]] = np.fromfile(_path, dtype=_column["dtype"],
+                                                   count=_column["length"])
+    return results
 
 def achievable_rate(rec_power, bw, noise_fig_db=3, noise_den_db=-174):
     noise_fig = 10**(noise_fig_db/10.)
     noise_den = 10**(noise_den_db/10.)
     noise_power = noise_fig*noise_den*bw
+    kernel = backend.get_kernel("achievable_rate", rec_power, noise_power, bw)
+    if kernel is not None:
+        return kernel(rec_power, noise_power, bw)
     snr = rec_power/noise_power
     return bw*np.log2(1 + snr)
+
+def bisect_vectorized(func, lower, upper, xtol=1e-12, max_iter=200):
+    lower, upper = np.broadcast_arrays(np.asarray(lower, dtype=float),
+                                       np.asarray(upper, dtype=float))
+    lower = np.copy(lower)
+    upper = np.copy(upper)
+    f_lower = func(lower)
+    for _iter in range(max_iter):
+        mid = .5*(lower+upper)
+        f_mid = func(mid)
+        same_sign = np.sign(f_mid) == np.sign(f_lower)
+        lower = np.where(same_sign, mid, lower)
+        f_lower = np.where(same_sign, f_mid, f_lower)
+        upper = np.where(same_sign, upper, mid)
+        if np.all(upper-lower <= xtol):
+            break
+    return .5*(lower+upper)
+
+def newton_bisect_vectorized(func, lower, upper, xtol=1e-12, max_iter=100,
+                             full_output=False):
+    # Safeguarded Newton iteration on a bracketed sign change. The function
+    # returns its value and derivative. Newton steps that leave the bracket or
+    # do not at least halve the previous step are replaced by bisection.
+    lower, upper = np.broadcast_arrays(np.asarray(lower, dtype=float),
+                                       np.asarray(upper, dtype=float))
+    lower = np.copy(lower)
+    upper = np.copy(upper)
+    f_lower = func(lower)[0]
+    x = .5*(lower+upper)
+    f_x, df_x = func(x)
+    step_old = np.abs(upper-lower)
+    iterations = np.zeros(x.shape, dtype=int)
+    converged = f_x == 0
+    for _iter in range(max_iter):
+        active = ~converged
+        if not np.any(active):
+            break
+        same_sign = np.sign(f_x) == np.sign(f_lower)
+        lower = np.where(same_sign, x, lower)
+        f_lower = np.where(same_sign, f_x, f_lower)
+        upper = np.where(same_sign, upper, x)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_newton = x - f_x/df_x
+            use_newton = (((x_newton-lower)*(x_newton-upper) <= 0)
+                          & (np.abs(x_newton-x) <= .5*step_old))
+        x_new = np.where(use_newton, x_newton, .5*(lower+upper))
+        step = np.abs(x_new-x)
+        x = np.where(active, x_new, x)
+        step_old = np.where(active, step, step_old)
+        iterations = iterations + active
+        f_x, df_x = func(x)
+        converged = converged | (step <= xtol) | (f_x == 0)
+    if full_output:
+        return x, {"iterations": iterations, "residual": f_x,
+                   "converged": converged}
+    return x
+
+def minimize_scalar_vectorized(func, lower, upper, xtol=1e-12, max_iter=200):
+    _inv_phi = (np.sqrt(5)-1)/2
+    lower, upper = np.broadcast_arrays(np.asarray(lower, dtype=float),
+                                       np.asarray(upper, dtype=float))
+    lower = np.copy(lower)
+    upper = np.copy(upper)
+    x_left = upper - _inv_phi*(upper-lower)
+    x_right = lower + _inv_phi*(upper-lower)
+    f_left = func(x_left)
+    f_right = func(x_right)
+    for _iter in range(max_iter):
+        left = f_left < f_right
+        upper = np.where(left, x_right, upper)
+        lower = np.where(left, lower, x_left)
+        x_new = np.where(left, upper - _inv_phi*(upper-lower),
+                         lower + _inv_phi*(upper-lower))
+        f_new = func(x_new)
+        x_left, x_right = (np.where(left, x_new, x_right),
+                           np.where(left, x_left, x_new))
+        f_left, f_right = (np.where(left, f_new, f_right),
+                           np.where(left, f_left, f_new))
+        if np.all(upper-lower <= xtol):
+            break
+    x_opt = .5*(lower+upper)
+    return x_opt, func(x_opt)
+
+def adaptive_grid(func, lower, upper, anchors=None, tol_db=.25, num_init=100,
+                  max_points=200000, xtol=1e-10):
+    # Logarithmic grid for curves with deep and narrow minima, e.g., the
+    # receive power around the critical distances. The anchors (positions of
+    # the minima) are included exactly and each interval is refined in log
+    # scale until the values in dB deviate less than tol_db from the linear
+    # interpolation between the end points. The function may return several
+    # curves (stacked along the first axes), which share the grid.
+    # Returns the grid and the function values on it.
+    grid = np.logspace(np.log10(lower), np.log10(upper), num_init)
+    if anchors is not None:
+        anchors = np.ravel(anchors)
+        anchors = anchors[np.logical_and(anchors >= lower, anchors <= upper)]
+        grid = np.union1d(grid, anchors)
+    values = np.asarray(func(grid))
+    refine = np.ones(len(grid)-1, dtype=bool)
+    while np.any(refine):
+        # Each interval is split into three parts (in log scale). Checking two
+        # inner points detects the narrow minima, which a single midpoint can
+        # miss when the curve is symmetric around it.
+        _idx = np.flatnonzero(refine)
+        _log_lower = np.log10(grid[_idx])
+        _log_width = np.log10(grid[_idx+1]) - _log_lower
+        _inner = 10**(_log_lower + np.outer([1/3, 2/3], _log_width))
+        _values_inner = np.asarray(func(_inner.ravel()))
+        _values_inner = np.reshape(_values_inner, _values_inner.shape[:-1] + _inner.shape)
+        _lower_db = to_decibel(values[..., _idx])
+        _upper_db = to_decibel(values[..., _idx+1])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _error = np.abs(to_decibel(_values_inner) - (
+                    np.expand_dims(_lower_db, -2)*[[2/3], [1/3]] +
+                    np.expand_dims(_upper_db, -2)*[[1/3], [2/3]]))
+        _error = np.max(np.reshape(_error, (-1, len(_idx))), axis=0)
+        _fail = np.logical_and(_error > tol_db,
+                               grid[_idx+1]-grid[_idx] > xtol*grid[_idx])
+        grid = np.insert(grid, np.repeat(_idx+1, 2), _inner.T.ravel())
+        values = np.insert(values, np.repeat(_idx+1, 2),
+                           np.reshape(np.swapaxes(_values_inner, -1, -2),
+                                      values.shape[:-1] + (-1,)), axis=-1)
+        _new = _idx + 2*np.arange(len(_idx))
+        refine = np.zeros(len(grid)-1, dtype=bool)
+        for _offset in range(3):
+            refine[_new[_fail]+_offset] = True
+        if len(grid) >= max_points:
+            LOGGER.warning(f"Adaptive grid stopped at {len(grid):d} points before reaching the tolerance of {tol_db:.2f} dB")
+            break
+    LOGGER.debug(f"Adaptive grid with {len(grid):d} points")
+    return grid, values